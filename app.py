@@ -1,15 +1,26 @@
-from flask import Flask, request, redirect, send_file, jsonify, render_template
+from flask import Flask, request, redirect, send_from_directory, render_template, make_response, stream_with_context
+from werkzeug.exceptions import NotFound
 import os
+import hashlib
 import time
+import secrets
+import threading
 import subprocess
 from datetime import datetime
 import json
 import argparse
+import atexit
 import logging
+from operator import itemgetter
+
+try:
+    import orjson
+except ImportError:  # optional, faster JSON encoding
+    orjson = None
 
 from queue import RequestQueue
 from web import ConversationManager
-from power_monitor import MockPowerMonitor, TC66PowerMonitor
+from power_monitor import MockPowerMonitor
 from llm_processor import MockLLMProcessor, LlamaProcessor
 from scheduler import PowerAwareScheduler
 
@@ -26,15 +37,68 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-# Setup command line arguments
+def env_flag(name):
+    """Read a boolean setting from the environment."""
+    return os.environ.get(name, "").lower() in ("1", "true", "yes")
+
+# Setup command line arguments; each one can also be set through the
+# environment, which is the only option when running under a WSGI server
 parser = argparse.ArgumentParser(description='Solar-powered LLM system with delay-tolerant networking')
-parser.add_argument('--model', help='Path to GGUF model file for llama.cpp')
-parser.add_argument('--llama-cpp', default='./llama.cpp/main', help='Path to llama.cpp executable (usually named "main")')
-parser.add_argument('--use-mock', action='store_true', help='Use mock LLM processor instead of real one')
-parser.add_argument('--use-mock-power', action='store_true', help='Use mock power monitor instead of real TC66')
-parser.add_argument('--immediate', action='store_true', help='Process prompts immediately without scheduling delays')
-parser.add_argument('--serial-port', default='/dev/ttyACM0', help='Serial port for the TC66 power meter')
-args = parser.parse_args()
+parser.add_argument('--model', default=os.environ.get('LLM_MODEL'), help='Path to GGUF model file for llama.cpp')
+parser.add_argument('--llama-cpp', default=os.environ.get('LLAMA_CPP', './llama.cpp/main'), help='Path to llama.cpp executable (usually named "main")')
+parser.add_argument('--llama-server', default=os.environ.get('LLAMA_SERVER'), help='Path to llama.cpp server executable; keeps the model loaded between requests')
+parser.add_argument('--server-parallel', type=int, default=int(os.environ.get('LLAMA_SERVER_PARALLEL', '1')), help='Number of requests the llama.cpp server generates at once')
+parser.add_argument('--llama-bindings', action='store_true', default=env_flag('LLAMA_BINDINGS'), help='Run the model in-process with llama-cpp-python (must be installed) instead of the llama.cpp executable')
+parser.add_argument('--threads', type=int, default=int(os.environ.get('LLAMA_THREADS', '0')) or None, help='Threads llama.cpp uses to generate tokens (default: number of cores, up to 16)')
+parser.add_argument('--use-mock', action='store_true', default=env_flag('USE_MOCK'), help='Use mock LLM processor instead of real one')
+parser.add_argument('--use-mock-power', action='store_true', default=env_flag('USE_MOCK_POWER'), help='Use mock power monitor instead of real TC66')
+parser.add_argument('--immediate', action='store_true', default=env_flag('IMMEDIATE'), help='Process prompts immediately without scheduling delays')
+parser.add_argument('--serial-port', default=os.environ.get('SERIAL_PORT', '/dev/ttyACM0'), help='Serial port for the TC66 power meter')
+# parse_known_args so the module can also be imported by a WSGI server,
+# whose own command line options aren't ours to parse
+args, _ = parser.parse_known_args()
+
+# Results of the llama.cpp --version probe, keyed by executable path, mtime and size
+LLAMA_VERSION_CACHE = os.path.expanduser("~/.cache/dtn-llm/llamacpp-version.json")
+
+def probe_llama_cpp(llama_cpp_path):
+    """Log the result of running the llama.cpp executable with --version.
+    
+    A successful result is cached until the executable changes, so restarts
+    don't have to run it again.
+    """
+    try:
+        st = os.stat(llama_cpp_path)
+        key = f"{os.path.abspath(llama_cpp_path)}:{st.st_mtime}:{st.st_size}"
+        try:
+            with open(LLAMA_VERSION_CACHE, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+        if key in cached:
+            logger.info(f" - llama.cpp version (cached): {cached[key]}")
+            return
+        
+        version_check = subprocess.run(
+            [llama_cpp_path, "--version"], 
+            stdout=subprocess.PIPE, 
+            stderr=subprocess.PIPE,
+            text=True,
+            timeout=5
+        )
+        logger.info(f" - llama.cpp version check returncode: {version_check.returncode}")
+        if version_check.stdout:
+            logger.info(f" - llama.cpp stdout: {version_check.stdout.strip()}")
+        if version_check.stderr:
+            logger.info(f" - llama.cpp stderr: {version_check.stderr.strip()}")
+        
+        if version_check.returncode == 0:
+            cached[key] = (version_check.stdout or version_check.stderr).strip()
+            os.makedirs(os.path.dirname(LLAMA_VERSION_CACHE), exist_ok=True)
+            with open(LLAMA_VERSION_CACHE, 'w') as f:
+                json.dump(cached, f)
+    except Exception as e:
+        logger.error(f" - llama.cpp version check error: {e}")
 
 # Initialize power monitor
 # In immediate mode, set a higher initial solar output to ensure processing can happen
@@ -47,12 +111,15 @@ if args.use_mock_power:
 else:
     # Try to initialize TC66PowerMonitor
     try:
+        from power_monitor import TC66PowerMonitor
         logger.info(f"Attempting to connect to TC66 power meter on {args.serial_port}")
         power_monitor = TC66PowerMonitor(
             serial_port=args.serial_port,
             initial_battery_level=initial_battery, 
             max_solar_output=initial_solar
         )
+        # Stop the background reader and release the serial port on exit
+        atexit.register(power_monitor.close)
         # Test connection by getting a reading
         reading = power_monitor.get_current_power_reading()
         logger.info(f"Successfully initialized TC66PowerMonitor. Current reading: {reading}")
@@ -88,22 +155,10 @@ else:
         logger.info(f" - llama.cpp exists: {os.path.exists(args.llama_cpp)}")
         logger.info(f" - llama.cpp executable: {os.access(args.llama_cpp, os.X_OK)}")
             
-        try:
-            # Check if llama.cpp executable can run
-            version_check = subprocess.run(
-                [args.llama_cpp, "--version"], 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.PIPE,
-                text=True,
-                timeout=5
-            )
-            logger.info(f" - llama.cpp version check returncode: {version_check.returncode}")
-            if version_check.stdout:
-                logger.info(f" - llama.cpp stdout: {version_check.stdout.strip()}")
-            if version_check.stderr:
-                logger.info(f" - llama.cpp stderr: {version_check.stderr.strip()}")
-        except Exception as e:
-            logger.error(f" - llama.cpp version check error: {e}")
+        # Check if llama.cpp executable can run, without holding up startup.
+        # The reloader's child process skips it, the parent has already run it.
+        if not os.environ.get("WERKZEUG_RUN_MAIN"):
+            threading.Thread(target=probe_llama_cpp, args=(args.llama_cpp,), daemon=True).start()
             
         try:
             # If the provided path is to llama.cpp file and not the executable, try to use 'main'
@@ -116,7 +171,11 @@ else:
             llm_processor = LlamaProcessor(
                 model_path=args.model,
                 power_monitor=power_monitor,
-                llama_cpp_path=args.llama_cpp
+                llama_cpp_path=args.llama_cpp,
+                server_path=args.llama_server,
+                server_parallel=args.server_parallel,
+                use_bindings=args.llama_bindings,
+                n_threads=args.threads
             )
             logger.info("Successfully initialized LlamaProcessor")
         except Exception as e:
@@ -132,11 +191,8 @@ else:
 def update_conversation_callback(conversation_id):
     """Callback function to update conversation page when a request completes."""
     if conversation_manager and conversation_id:
-        logger.debug(f"Updating conversation page for ID: {conversation_id}")
-        try:
-            conversation_manager.update_conversation_page(conversation_id)
-        except Exception as e:
-            logger.error(f"Error updating conversation page: {e}")
+        logger.debug(f"Scheduling conversation page update for ID: {conversation_id}")
+        schedule_page_update(conversation_id, delay=PAGE_UPDATE_DEBOUNCE)
     elif not conversation_id:
         logger.warning("Cannot update conversation: conversation_id is None")
 
@@ -155,6 +211,97 @@ conversation_manager = ConversationManager(
     power_monitor=power_monitor
 )
 
+# Scheduler callbacks re-render conversation pages off the request path on a
+# single writer thread; submit_prompt renders its page itself, since the
+# redirect that follows must show the new prompt. Each
+# pending conversation maps to the monotonic time its render is due; another
+# update before then pushes the deadline back, so a burst costs one render.
+PAGE_UPDATE_DEBOUNCE = 0.25  # seconds
+_pending_pages = {}
+_pending_pages_cond = threading.Condition()
+# Held for each render, so one made on the request path can't be overwritten
+# by a render the writer started from older data
+_page_render_lock = threading.Lock()
+
+def _page_writer_loop():
+    """Render conversation pages as they come due (runs on the page writer thread)."""
+    while True:
+        with _pending_pages_cond:
+            while True:
+                if not _pending_pages:
+                    _pending_pages_cond.wait()
+                    continue
+                conversation_id, due = min(_pending_pages.items(), key=itemgetter(1))
+                remaining = due - time.monotonic()
+                if remaining <= 0:
+                    del _pending_pages[conversation_id]
+                    break
+                _pending_pages_cond.wait(remaining)
+        try:
+            with _page_render_lock:
+                conversation_manager.update_conversation_page(conversation_id)
+        except Exception as e:
+            logger.error(f"Error updating conversation page: {e}")
+        _invalidate_recent()
+
+def schedule_page_update(conversation_id, delay=0.0):
+    """Queue a re-render of a conversation page after `delay` seconds.
+    
+    Scheduling a conversation that is already pending replaces its deadline,
+    so rapid updates are coalesced into a single render.
+    """
+    with _pending_pages_cond:
+        _pending_pages[conversation_id] = time.monotonic() + delay
+        _pending_pages_cond.notify()
+
+_page_writer = threading.Thread(target=_page_writer_loop, daemon=True)
+_page_writer.start()
+
+# Cache of the recent conversations listing shown on the home page
+RECENT_CONVERSATIONS_TTL = 5.0  # seconds
+_recent_convos_cache = {"ts": 0.0, "data": []}
+
+def _invalidate_recent():
+    """Force the next home page hit to rescan the conversations directory."""
+    _recent_convos_cache["ts"] = 0.0
+
+def list_recent_conversations():
+    """List (conversation_id, time_str) pairs, most recent first.
+    
+    The directory scan is cached for RECENT_CONVERSATIONS_TTL seconds so that
+    repeated home page hits don't stat every conversation each time.
+    """
+    now = time.time()
+    if now - _recent_convos_cache["ts"] < RECENT_CONVERSATIONS_TTL:
+        return _recent_convos_cache["data"]
+    
+    # The conversation manager creates its pages directory at startup
+    recent_conversations = []
+    with os.scandir(conversation_manager.pages_dir) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            try:
+                # Get conversation creation time from file modification time
+                st = os.stat(f"{entry.path}/index.html")
+            except OSError:
+                continue
+            recent_conversations.append((st.st_mtime, entry.name))
+    
+    # Sort by most recent first on the raw mtime, then format for display
+    recent_conversations.sort(key=itemgetter(0), reverse=True)
+    recent_conversations = [
+        (conversation_id, time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime)))
+        for mtime, conversation_id in recent_conversations
+    ]
+    
+    _recent_convos_cache["ts"] = now
+    _recent_convos_cache["data"] = recent_conversations
+    return recent_conversations
+
+# Last rendered home page, reused while its inputs are unchanged
+_index_cache = {"page": (None, "", "")}  # (key, body, etag)
+
 @app.route('/')
 def index():
     """Home page with form to start a new conversation."""
@@ -162,27 +309,24 @@ def index():
     queue_length = request_queue.get_queue_length()
     
     # List recent conversations
-    recent_conversations = []
-    if os.path.exists("static/conversations"):
-        for conversation_id in os.listdir("static/conversations"):
-            try:
-                # Get conversation creation time from file modification time
-                path = f"static/conversations/{conversation_id}/index.html"
-                if os.path.exists(path):
-                    mtime = os.path.getmtime(path)
-                    time_str = datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M')
-                    recent_conversations.append((conversation_id, time_str))
-            except:
-                pass
+    recent_conversations = list_recent_conversations()
     
-    # Sort by most recent first
-    recent_conversations.sort(key=lambda x: x[1], reverse=True)
+    # The page only depends on these values, so skip rendering if they haven't changed
+    key = (power_status['battery_level'], power_status['solar_output'],
+           queue_length, tuple(recent_conversations))
+    cached_key, body, etag = _index_cache["page"]
+    if cached_key != key:
+        body = render_template('index.html', 
+                               battery_level=power_status['battery_level'],
+                               solar_output=power_status['solar_output'],
+                               queue_length=queue_length,
+                               recent_conversations=recent_conversations)
+        etag = hashlib.md5(body.encode()).hexdigest()
+        _index_cache["page"] = (key, body, etag)
     
-    return render_template('index.html', 
-                          battery_level=power_status['battery_level'],
-                          solar_output=power_status['solar_output'],
-                          queue_length=queue_length,
-                          recent_conversations=recent_conversations)
+    response = make_response(body)
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 @app.route('/new', methods=['POST'])
 def new_conversation():
@@ -193,8 +337,7 @@ def new_conversation():
         return redirect('/')
     
     # Create a new conversation ID first
-    import uuid
-    conversation_id = str(uuid.uuid4())
+    conversation_id = secrets.token_hex(16)
     
     # Add prompt to scheduler queue with the conversation ID
     request_id, estimated_time = scheduler.enqueue_prompt(conversation_id, initial_prompt)
@@ -208,19 +351,24 @@ def new_conversation():
     )
     
     # Generate the conversation page
-    conversation_manager.update_conversation_page(conversation_id)
+    schedule_page_update(conversation_id)
+    _invalidate_recent()
     
     return redirect(f'/conversation/{conversation_id}')
 
 @app.route('/conversation/<conversation_id>')
 def view_conversation(conversation_id):
     """View a conversation."""
-    # Check if conversation exists
-    if not conversation_manager.conversation_exists(conversation_id):
+    # Serve the static HTML file; conditional requests get a 304 while it's unchanged.
+    # max_age=0 makes browsers revalidate every time, so the page shown after
+    # submitting a prompt is never a cached copy from before it was added.
+    # A missing page is detected by the open itself rather than a separate check.
+    try:
+        return send_from_directory(conversation_manager.pages_dir,
+                                   f"{conversation_id}/index.html",
+                                   conditional=True, max_age=0)
+    except NotFound:
         return "Conversation not found", 404
-    
-    # Simply serve the static HTML file
-    return send_file(conversation_manager.get_conversation_path(conversation_id))
 
 @app.route('/submit', methods=['POST'])
 def submit_prompt():
@@ -234,45 +382,77 @@ def submit_prompt():
     # Add prompt to scheduler queue
     request_id, estimated_time = scheduler.enqueue_prompt(conversation_id, prompt)
     
-    # Update conversation page
-    conversation_manager.update_conversation_page(conversation_id)
+    # Update conversation page before redirecting, so the page the browser
+    # is sent to already shows the new prompt
+    with _page_render_lock:
+        conversation_manager.update_conversation_page(conversation_id)
     
     return redirect(f'/conversation/{conversation_id}')
 
+def json_bytes(data):
+    """Serialize API payloads compactly, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+def json_response(data):
+    """Build a JSON response from json_bytes()."""
+    return app.response_class(json_bytes(data), mimetype='application/json')
+
+# Cache of the serialized /api/status body, shared by all pollers
+STATUS_CACHE_TTL = 0.5  # seconds
+_status_cache = {"ts": 0.0, "body": b""}
+_status_lock = threading.Lock()
+
 @app.route('/api/status')
 def system_status():
     """API endpoint for system status."""
-    power_status = power_monitor.get_current_status()
-    queue_status = scheduler.get_queue_status()
+    # The body is stored before its timestamp, so a fresh timestamp means a fresh body
+    if time.monotonic() - _status_cache["ts"] < STATUS_CACHE_TTL:
+        body = _status_cache["body"]
+    else:
+        # Only one poller refreshes; the others wait for its result
+        with _status_lock:
+            now = time.monotonic()
+            if now - _status_cache["ts"] >= STATUS_CACHE_TTL:
+                power_status = power_monitor.get_current_status()
+                queue_status = scheduler.get_queue_status()
+                
+                _status_cache["body"] = json_bytes({
+                    "battery_level": power_status["battery_level"],
+                    "solar_output": power_status["solar_output"],
+                    "queue_length": queue_status["queue_length"],
+                    "processing_active": queue_status["processing_active"],
+                    "timestamp": int(time.time())
+                })
+                _status_cache["ts"] = now
+            body = _status_cache["body"]
     
-    return jsonify({
-        "battery_level": power_status["battery_level"],
-        "solar_output": power_status["solar_output"],
-        "queue_length": queue_status["queue_length"],
-        "processing_active": queue_status["processing_active"],
-        "timestamp": int(time.time())
-    })
+    response = app.response_class(body, mimetype='application/json')
+    # Let browsers and proxies reuse the snapshot too
+    response.headers['Cache-Control'] = 'max-age=1'
+    return response
 
 @app.route('/api/request/<request_id>')
 def request_status(request_id):
     """API endpoint for specific request status."""
-    return jsonify(scheduler.get_request_info(request_id))
+    return json_response(scheduler.get_request_info(request_id))
 
 @app.route('/download/<conversation_id>')
 def download_conversation(conversation_id):
     """Download conversation as text file."""
-    requests = request_queue.get_conversation_requests(conversation_id)
-    
-    text_content = f"Solar LLM Conversation {conversation_id}\n"
-    text_content += f"Downloaded on {datetime.now().strftime('%Y-%m-%d %H:%M')}\n\n"
-    
-    for request in requests:
-        text_content += f"You: {request['prompt']}\n\n"
-        if request['status'] == 'completed' and request['response']:
-            text_content += f"AI: {request['response']}\n\n"
-    
+    def generate():
+        # Stream rows straight from the database instead of building the whole text
+        yield f"Solar LLM Conversation {conversation_id}\n"
+        yield f"Downloaded on {datetime.now().strftime('%Y-%m-%d %H:%M')}\n\n"
+
+        for request in request_queue.iter_conversation_requests(conversation_id):
+            yield f"You: {request['prompt']}\n\n"
+            if request['status'] == 'completed' and request['response']:
+                yield f"AI: {request['response']}\n\n"
+
     response = app.response_class(
-        response=text_content,
+        response=stream_with_context(generate()),
         mimetype='text/plain',
         headers={'Content-Disposition': f'attachment;filename=conversation-{conversation_id}.txt'}
     )
@@ -285,22 +465,22 @@ def simulate_charge():
     amount = float(request.args.get('amount', 10))
     
     # Handle different power monitor types
-    if isinstance(power_monitor, MockPowerMonitor):
+    if power_monitor.MONITOR_TYPE == "mock":
         current = power_monitor.battery_level
         power_monitor.battery_level = min(100, current + amount)
-        return jsonify({"status": "ok", "battery_level": power_monitor.battery_level, "monitor_type": "mock"})
-    elif isinstance(power_monitor, TC66PowerMonitor):
+        return json_response({"status": "ok", "battery_level": power_monitor.battery_level, "monitor_type": "mock"})
+    elif power_monitor.MONITOR_TYPE == "tc66":
         # For TC66, we can't directly manipulate the battery level because it's read from hardware
         # But we can report the current estimated level
         current_level = power_monitor.estimate_battery_level()
-        return jsonify({
+        return json_response({
             "status": "info", 
             "message": "Cannot simulate charging with hardware power monitor",
             "battery_level": current_level,
             "monitor_type": "tc66"
         })
     else:
-        return jsonify({"status": "error", "message": "Unknown power monitor type"})
+        return json_response({"status": "error", "message": "Unknown power monitor type"})
 
 @app.route('/simulate/discharge')
 def simulate_discharge():
@@ -308,40 +488,37 @@ def simulate_discharge():
     amount = float(request.args.get('amount', 10))
     
     # Handle different power monitor types
-    if isinstance(power_monitor, MockPowerMonitor):
+    if power_monitor.MONITOR_TYPE == "mock":
         current = power_monitor.battery_level
         power_monitor.battery_level = max(0, current - amount)
-        return jsonify({"status": "ok", "battery_level": power_monitor.battery_level, "monitor_type": "mock"})
-    elif isinstance(power_monitor, TC66PowerMonitor):
+        return json_response({"status": "ok", "battery_level": power_monitor.battery_level, "monitor_type": "mock"})
+    elif power_monitor.MONITOR_TYPE == "tc66":
         # For TC66, we can't directly manipulate the battery level
         current_level = power_monitor.estimate_battery_level()
-        return jsonify({
+        return json_response({
             "status": "info", 
             "message": "Cannot simulate discharging with hardware power monitor",
             "battery_level": current_level,
             "monitor_type": "tc66"
         })
     else:
-        return jsonify({"status": "error", "message": "Unknown power monitor type"})
+        return json_response({"status": "error", "message": "Unknown power monitor type"})
         
 @app.route('/api/power/readings')
 def power_readings():
     """Get detailed power readings."""
-    readings = power_monitor.get_current_power_reading()
-    status = power_monitor.get_current_status()
-    
     # Combine all available data
-    result = {**readings, **status}
+    result = power_monitor.get_full_snapshot()
     
     # Add monitor type information
-    if isinstance(power_monitor, MockPowerMonitor):
-        result["monitor_type"] = "mock"
-    elif isinstance(power_monitor, TC66PowerMonitor):
-        result["monitor_type"] = "tc66"
-    else:
-        result["monitor_type"] = "unknown"
+    result["monitor_type"] = power_monitor.MONITOR_TYPE
         
-    return jsonify(result)
+    return json_response(result)
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # The debugger and reloader are for development only; the reloader would
+    # also start a second scheduler in its child process
+    debug = os.environ.get("FLASK_ENV") == "development"
+    # Reloading would also load a real model a second time
+    app.run(debug=debug, use_reloader=debug and not args.model,
+            host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
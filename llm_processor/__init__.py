@@ -1,5 +1,6 @@
 from .base_processor import BaseLLMProcessor
 from .mock_processor import MockLLMProcessor
 from .llama_processor import LlamaProcessor
+from .llama_server import LlamaServer, LlamaServerTimeout
 
-__all__ = ['BaseLLMProcessor', 'MockLLMProcessor', 'LlamaProcessor']
\ No newline at end of file
+__all__ = ['BaseLLMProcessor', 'MockLLMProcessor', 'LlamaProcessor', 'LlamaServer', 'LlamaServerTimeout']
\ No newline at end of file
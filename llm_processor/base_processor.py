@@ -4,6 +4,12 @@ from typing import Dict, Any, Optional
 class BaseLLMProcessor(ABC):
     """Base class for LLM processing implementations."""
     
+    # Subclasses declare their attributes in __slots__ so instances have no __dict__
+    __slots__ = ()
+    
+    # How many requests the processor can generate at once, batched together
+    max_concurrent_requests = 1
+    
     @abstractmethod
     def generate_response(self, prompt: str, max_tokens: Optional[int] = None) -> str:
         """Generate a response to the prompt.
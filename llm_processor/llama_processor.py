@@ -1,10 +1,49 @@
+import bisect
+import logging
 import os
+import re
+import select
+import shutil
 import subprocess
 import time
-import threading
 from typing import Optional
 
 from .base_processor import BaseLLMProcessor
+from .llama_server import LlamaServer, LlamaServerTimeout
+from .power_tracker import ProcessingPowerTracker
+
+try:
+    from llama_cpp import Llama, StoppingCriteriaList
+except ImportError:  # optional, in-process inference via llama-cpp-python
+    Llama = None
+
+
+logger = logging.getLogger(__name__)
+
+# Battery level below which generation is stopped
+MIN_BATTERY_LEVEL = 20
+# Longest wait between battery checks, when the battery is well above it
+MAX_BATTERY_CHECK_INTERVAL = 30.0
+
+
+def battery_check_interval(battery_level: float, min_interval: float) -> float:
+    """Seconds to wait before the next battery check during generation.
+
+    The interval grows by half a second per percent above the cut-off, so
+    the monitor is read rarely while the battery is healthy and as often
+    as `min_interval` allows close to the cut-off.
+    """
+    margin = battery_level - MIN_BATTERY_LEVEL
+    return max(min_interval, min(MAX_BATTERY_CHECK_INTERVAL, margin * 0.5))
+
+
+# Response length limits by battery level: up to and including each
+# threshold, the token limit at the same index; above the last, the last limit
+MAX_TOKENS_BATTERY_THRESHOLDS = (30, 50, 80)
+MAX_TOKENS_BY_BATTERY = (256, 512, 1024, 2048)
+
+# End-of-text markers llama.cpp may leave in its output
+SPECIAL_TOKENS_RE = re.compile(r"<(?:end|eos)>")
 
 
 class LlamaProcessor(BaseLLMProcessor):
@@ -13,13 +52,29 @@ class LlamaProcessor(BaseLLMProcessor):
     with power-aware processing.
     """
 
+    LOW_POWER_NOTE = "\n[Note: Response may have been truncated due to low power]"
+
+    __slots__ = (
+        "model_path", "power_monitor", "llama_cpp_path", "context_size",
+        "temperature", "predictable_power", "llm", "n_threads", "n_threads_batch",
+        "n_gpu_layers",
+        "server", "_cmd_options", "_power_tracker"
+    )
+
     def __init__(
         self,
         model_path: str,
         power_monitor=None,
         llama_cpp_path: str = "./llama.cpp/main",
         context_size: int = 2048,
-        temperature: float = 0.7
+        temperature: float = 0.7,
+        use_bindings: bool = False,
+        predictable_power: bool = False,
+        server_path: Optional[str] = None,
+        server_port: int = 8081,
+        server_parallel: int = 1,
+        n_threads: Optional[int] = None,
+        n_threads_batch: Optional[int] = None
     ):
         """Initialize the Llama processor.
 
@@ -29,17 +84,81 @@ class LlamaProcessor(BaseLLMProcessor):
             llama_cpp_path: Path to the llama.cpp executable
             context_size: Context size for model inference
             temperature: Temperature parameter for sampling
+            use_bindings: Load the model in-process with llama-cpp-python
+                instead of running `llama_cpp_path` per request. Raises
+                ImportError if llama-cpp-python isn't installed
+            predictable_power: Disable memory mapping of the model so power
+                draw is more even, at the cost of slower loading
+            server_path: Path to the llama.cpp server executable. When given,
+                the model is loaded once by a persistent llama-server process
+                instead of by llama.cpp on every request
+            server_port: Local port for the llama.cpp server
+            server_parallel: Number of requests the llama.cpp server
+                generates at once, each with its own context of `context_size`
+            n_threads: Threads used to generate tokens. Defaults to the
+                number of cores, up to 16
+            n_threads_batch: Threads used to process the prompt. Defaults to
+                the number of cores
         """
         self.model_path = model_path
         self.power_monitor = power_monitor
         self.llama_cpp_path = llama_cpp_path
         self.context_size = context_size
         self.temperature = temperature
+        self.predictable_power = predictable_power
+        self.llm = None
+        self.server = None
+        # Shared by overlapping requests when the server batches them
+        self._power_tracker = ProcessingPowerTracker(power_monitor) if power_monitor else None
+
+        # Use the available cores, and offload all layers when a GPU is present.
+        # Generating tokens is limited by memory bandwidth, so it gains little
+        # from many threads; processing the prompt scales with every core.
+        cpu_count = os.cpu_count() or 1
+        self.n_threads = n_threads or min(16, cpu_count)
+        self.n_threads_batch = n_threads_batch or cpu_count
+        self.n_gpu_layers = 999 if shutil.which("nvidia-smi") else 0
 
         # Check if model file exists
         if not os.path.exists(model_path):
             raise FileNotFoundError(f"Model file not found: {model_path}")
 
+        if server_path:
+            # Start the server now so the model load isn't paid by the first request
+            # The server splits its context between the parallel requests
+            options = [
+                "-m", model_path,
+                "--ctx-size", str(context_size * server_parallel),
+                "-t", str(self.n_threads),
+                "-tb", str(self.n_threads_batch)
+            ]
+            if self.n_gpu_layers:
+                options += ["-ngl", str(self.n_gpu_layers)]
+            if predictable_power:
+                options.append("--no-mmap")
+            self.server = LlamaServer(
+                server_path, options, port=server_port, parallel=server_parallel
+            )
+            self.server.start()
+            return
+
+        if use_bindings:
+            if Llama is None:
+                raise ImportError(
+                    "use_bindings needs llama-cpp-python: pip install llama-cpp-python"
+                )
+            # Load the weights once and keep them for every request
+            self.llm = Llama(
+                model_path=model_path,
+                n_ctx=context_size,
+                n_threads=self.n_threads,
+                n_threads_batch=self.n_threads_batch,
+                n_gpu_layers=self.n_gpu_layers,
+                use_mmap=not predictable_power,
+                verbose=False
+            )
+            return
+
         # Check if llama.cpp executable exists and is executable
         if not os.path.exists(llama_cpp_path):
             raise FileNotFoundError(
@@ -54,13 +173,37 @@ class LlamaProcessor(BaseLLMProcessor):
                 f"Make sure you're pointing to the compiled binary, not a source file."
             )
 
+        # The llama.cpp options that are the same for every request
+        self._cmd_options = [
+            "--ctx_size", str(self.context_size),
+            "--temp", str(self.temperature),
+            "-t", str(self.n_threads),
+            "-tb", str(self.n_threads_batch),
+            "-b", "2048",
+            # Only print the generated text, not the prompt before it
+            "--no-display-prompt"
+        ]
+        if self.n_gpu_layers:
+            self._cmd_options += ["-ngl", str(self.n_gpu_layers)]
+        if self.predictable_power:
+            # Disable memory mapping for predictable power usage
+            self._cmd_options.append("--no-mmap")
+        logger.debug("llama.cpp options: %s", " ".join(self._cmd_options))
+
+    @property
+    def max_concurrent_requests(self) -> int:
+        """How many requests can be generated at once, batched by the server."""
+        return self.server.parallel if self.server is not None else 1
+
     def generate_response(
         self, prompt: str, max_tokens: Optional[int] = None
     ) -> str:
         """Generate a response using llama.cpp.
 
-        This method runs the llama.cpp executable as a subprocess and monitors
-        power during generation.
+        The model runs in a persistent llama.cpp server when one is
+        configured, in-process when the llama-cpp-python bindings were
+        requested and are installed, and otherwise as a llama.cpp
+        subprocess. Power is monitored during generation in every case.
 
         Args:
             prompt: The input prompt text
@@ -68,124 +211,64 @@ class LlamaProcessor(BaseLLMProcessor):
 
         Returns:
             str: The generated response
-        """
-        # Configure max tokens based on available power if not specified
-        if max_tokens is None:
-            max_tokens = self.determine_max_tokens()
-
-        # Set process to None initially
-        process = None
 
+        Raises:
+            LlamaServerTimeout: If the llama.cpp server stops responding
+        """
+        started = None
         try:
-            print(f"[DEBUG] LlamaProcessor: Starting to process prompt: {prompt[:30]}...")
-            print(f"[DEBUG] LlamaProcessor: Model path: {self.model_path}")
-            print(f"[DEBUG] LlamaProcessor: Llama.cpp path: {self.llama_cpp_path}")
+            logger.debug("Starting to process prompt: %.30s...", prompt)
             
-            # Start power monitoring if available
-            if self.power_monitor:
-                self.power_monitor.set_processing_state(True)
-                print(f"[DEBUG] Power status: {self.power_monitor.get_current_status()}")
+            # Start power monitoring if available, reading the status once
+            battery_level = None
+            if self._power_tracker:
+                started = self._power_tracker.start()
+                power_status = self.power_monitor.get_current_status()
+                battery_level = power_status["battery_level"]
+                logger.debug("Power status: %s", power_status)
+
+            # Configure max tokens based on available power if not specified
+            if max_tokens is None:
+                max_tokens = self.determine_max_tokens(battery_level)
 
             # Start time for measuring duration
             start_time = time.time()
 
-            # Build command for llama.cpp
-            cmd = [
-                self.llama_cpp_path,
-                "-m", self.model_path,
-                "-p", prompt,
-                "--ctx_size", str(self.context_size),
-                "--temp", str(self.temperature),
-                "--n_predict", str(max_tokens),
-                # Disable memory mapping for predictable power usage
-                "--no-mmap"
-            ]
-            
-            print(f"[DEBUG] Executing command: {' '.join(cmd)}")
-
-            # Start llama.cpp process
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1,  # Line buffered
-            )
-
-            # Create thread to monitor power
-            stop_flag = threading.Event()
-            if self.power_monitor:
-                power_thread = threading.Thread(
-                    target=self._monitor_power_during_generation,
-                    args=(process, stop_flag)
+            if self.server is not None:
+                output = self.server.complete(
+                    prompt, max_tokens, self.temperature, self._battery_low_check()
                 )
-                power_thread.daemon = True
-                power_thread.start()
-
-            # Collect output
-            output = ""
-            print("[DEBUG] Reading output from llama.cpp...")
-            for line in process.stdout:
-                output += line
-                print(f"[DEBUG] llama.cpp output: {line.strip()}")
-
-            # Read from stderr in a non-blocking way
-            from fcntl import fcntl, F_GETFL, F_SETFL
-            import os
-            
-            # Set stderr to non-blocking mode
-            flags = fcntl(process.stderr, F_GETFL)
-            fcntl(process.stderr, F_SETFL, flags | os.O_NONBLOCK)
-            
-            # Try to read any stderr output
-            try:
-                stderr_output = process.stderr.read()
-                if stderr_output:
-                    print(f"[DEBUG] llama.cpp stderr: {stderr_output}")
-            except Exception as e:
-                print(f"[DEBUG] Error reading stderr: {e}")
-
-            # Stop power monitoring thread
-            if self.power_monitor:
-                stop_flag.set()
-                power_thread.join(timeout=2)
-
-            # Wait for process to complete
-            returncode = process.wait()
-            print(f"[DEBUG] llama.cpp process completed with return code: {returncode}")
+            elif self.llm is not None:
+                output = self._generate_in_process(prompt, max_tokens)
+            else:
+                output = self._generate_with_subprocess(prompt, max_tokens)
 
             # End time for measuring duration
             end_time = time.time()
             processing_duration = end_time - start_time
-            print(f"[DEBUG] Processing took {processing_duration:.2f} seconds")
+            logger.debug("Processing took %.2f seconds", processing_duration)
 
             # Calculate power used
-            if self.power_monitor:
-                # Simulate battery discharge (5W power draw during processing)
-                self.power_monitor.simulate_battery_change(processing_duration, 5.0)
-                print(f"[DEBUG] Updated battery level: {self.power_monitor.estimate_battery_level():.2f}%")
+            if self._power_tracker:
+                # Simulate battery discharge (5W power draw during processing),
+                # for the time not already charged to overlapping requests
+                self._power_tracker.charge(started)
+                battery_level = self.power_monitor.estimate_battery_level()
+                logger.debug("Updated battery level: %.2f%%", battery_level)
 
             # Clean up the output - remove prompt and llama.cpp formatting
-            response = self._clean_response(output, prompt)
-            print(f"[DEBUG] Generated response: {response[:100]}...")
+            response = self._clean_response(output, prompt, battery_level)
+            logger.debug("Generated response: %.100s...", response)
 
             return response
 
+        except LlamaServerTimeout:
+            # A stalled server is a failed request, not a response
+            raise
+
         except Exception as e:
             # Clean up in case of error
-            print(f"[DEBUG] Error in LlamaProcessor: {str(e)}")
-            import traceback
-            print(f"[DEBUG] Traceback: {traceback.format_exc()}")
-            
-            if process and process.poll() is None:
-                try:
-                    process.terminate()
-                    process.wait(timeout=5)
-                    print("[DEBUG] Process terminated")
-                except Exception as term_e:
-                    print(f"[DEBUG] Error terminating process: {term_e}")
-                    process.kill()
-                    print("[DEBUG] Process killed")
+            logger.exception("Error in LlamaProcessor: %s", e)
 
             error_message = f"Error generating response with llama.cpp: {e}"
             
@@ -202,90 +285,236 @@ class LlamaProcessor(BaseLLMProcessor):
             return error_message
 
         finally:
-            # Always reset processing state
-            if self.power_monitor:
-                self.power_monitor.set_processing_state(False)
+            # Always reset processing state, once no other request is running
+            if started is not None:
+                self._power_tracker.finish()
 
-    def _monitor_power_during_generation(self, process, stop_flag):
-        """Monitor power levels during generation and stop if battery is low.
+    def _generate_in_process(self, prompt: str, max_tokens: int) -> str:
+        """Generate text with the in-process llama-cpp-python model.
+
+        Generation stops early if the battery drops below 20%, checked at
+        most every 5 seconds so a slow power monitor doesn't throttle decoding.
 
         Args:
-            process: The subprocess running llama.cpp
-            stop_flag: Threading event to signal when to stop monitoring
+            prompt: The input prompt text
+            max_tokens: Maximum number of tokens to generate
+
+        Returns:
+            str: The generated text, without the prompt
         """
-        while process.poll() is None and not stop_flag.is_set():
-            # Check power status
-            if self.power_monitor:
-                battery_level = self.power_monitor.estimate_battery_level()
+        stopping_criteria = None
+        battery_low = self._battery_low_check()
+        if battery_low:
+            stopping_criteria = StoppingCriteriaList(
+                [lambda input_ids, logits: battery_low()]
+            )
 
-                # If battery gets too low, terminate the process
-                if battery_level < 20:
-                    # Send terminate signal to process
-                    try:
-                        process.terminate()
-                        # Give it 5 seconds to terminate gracefully
-                        process.wait(timeout=5)
-                    except Exception:
-                        # Force kill if it doesn't terminate
-                        process.kill()
+        result = self.llm(
+            prompt,
+            max_tokens=max_tokens,
+            temperature=self.temperature,
+            stop=["<end>", "<eos>"],
+            stopping_criteria=stopping_criteria
+        )
+        return result["choices"][0]["text"]
 
-                    break
+    def _battery_low_check(self, check_interval: float = 5.0):
+        """Return a function that reports whether the battery is below 20%.
 
-            # Sleep briefly to avoid constant checking
-            time.sleep(5)
+        The power monitor is read at most every `check_interval` seconds so
+        a slow monitor doesn't throttle decoding, and less often the further
+        the battery is above the cut-off; in between, the function returns
+        False.
 
-    def _clean_response(self, output: str, prompt: str) -> str:
+        Returns:
+            The check function, or None without a power monitor
+        """
+        if not self.power_monitor:
+            return None
+
+        next_check = [time.monotonic() + check_interval]
+
+        def battery_low():
+            now = time.monotonic()
+            if now < next_check[0]:
+                return False
+            battery_level = self.power_monitor.estimate_battery_level()
+            next_check[0] = now + battery_check_interval(battery_level, check_interval)
+            return battery_level < MIN_BATTERY_LEVEL
+
+        return battery_low
+
+    def _generate_with_subprocess(self, prompt: str, max_tokens: int) -> str:
+        """Generate text by running the llama.cpp executable.
+
+        Args:
+            prompt: The input prompt text
+            max_tokens: Maximum number of tokens to generate
+
+        Returns:
+            str: The raw llama.cpp output
+        """
+        # Set process to None initially
+        process = None
+
+        try:
+            # Build command for llama.cpp
+            cmd = [
+                self.llama_cpp_path,
+                "-m", self.model_path,
+                "-p", prompt,
+                "--n_predict", str(max_tokens),
+                *self._cmd_options
+            ]
+
+            # Start llama.cpp process
+            process = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                # stderr is only read to be logged, so skip it unless it will be
+                stderr=subprocess.PIPE if logger.isEnabledFor(logging.DEBUG) else subprocess.DEVNULL,
+                # Binary and unbuffered: the pipes are read from their file
+                # descriptors and decoded once the output is complete
+                bufsize=0,
+            )
+
+            # Read stdout and stderr as they arrive, checking the battery in
+            # between, until llama.cpp closes its output
+            output, stderr_output = self._read_process_output(process)
+            if stderr_output:
+                logger.debug("llama.cpp stderr: %s", stderr_output)
+
+            # Wait for process to complete
+            returncode = process.wait()
+            logger.debug("llama.cpp process completed with return code: %s", returncode)
+
+            return output
+
+        except Exception:
+            if process and process.poll() is None:
+                try:
+                    process.terminate()
+                    process.wait(timeout=5)
+                    logger.debug("Process terminated")
+                except Exception as term_e:
+                    logger.warning("Error terminating process: %s", term_e)
+                    process.kill()
+                    logger.warning("Process killed")
+            raise
+
+    def _read_process_output(self, process, check_interval: float = 1.0):
+        """Collect llama.cpp output, stopping it if the battery gets too low.
+
+        Both pipes are drained with select so a chatty stderr can't fill up
+        and block the process; stderr may also not be piped at all. The battery is checked at most every
+        `check_interval` seconds, backing off while it is well above 20%;
+        below 20% the process is terminated, and killed if it hasn't exited
+        5 seconds later.
+
+        Args:
+            process: The subprocess running llama.cpp
+            check_interval: Shortest time between battery checks, in seconds
+
+        Returns:
+            Tuple of the stdout and stderr text, stderr empty if not piped
+        """
+        stdout_chunks, stderr_chunks = [], []
+        streams = {process.stdout.fileno(): stdout_chunks}
+        if process.stderr is not None:
+            streams[process.stderr.fileno()] = stderr_chunks
+        open_fds = list(streams)
+        next_check = time.monotonic() + check_interval
+        terminated_at = None
+
+        while open_fds:
+            # Wake up for the next battery check, or the kill deadline
+            if terminated_at is not None:
+                timeout = check_interval
+            elif self.power_monitor:
+                timeout = max(0.0, next_check - time.monotonic())
+            else:
+                timeout = None
+            ready, _, _ = select.select(open_fds, [], [], timeout)
+            for fd in ready:
+                data = os.read(fd, 65536)
+                if data:
+                    streams[fd].append(data)
+                else:
+                    open_fds.remove(fd)
+
+            now = time.monotonic()
+            if terminated_at is not None:
+                if now - terminated_at > 5 and process.poll() is None:
+                    process.kill()
+            elif self.power_monitor and now >= next_check:
+                battery_level = self.power_monitor.estimate_battery_level()
+                next_check = now + battery_check_interval(battery_level, check_interval)
+                if battery_level < MIN_BATTERY_LEVEL:
+                    logger.warning("Battery low, stopping llama.cpp")
+                    process.terminate()
+                    terminated_at = now
+
+        stdout_text, stderr_text = (
+            b"".join(chunks).decode("utf-8", errors="replace")
+            for chunks in (stdout_chunks, stderr_chunks)
+        )
+        return stdout_text, stderr_text
+
+    def _clean_response(
+        self, output: str, prompt: str, battery_level: Optional[float] = None
+    ) -> str:
         """Clean llama.cpp output by removing prompt and system text.
 
         Args:
             output: Raw output from llama.cpp
             prompt: Original prompt that was sent
+            battery_level: Battery level after generation, if already known
 
         Returns:
             str: Cleaned response text
         """
-        # Basic cleaning - handle different llama.cpp output formats
-        # Typically llama.cpp includes the prompt in the output
-
-        # Try to find the prompt in the output
-        if prompt in output:
-            response = output.split(prompt, 1)[1].strip()
+        # Basic cleaning - handle different llama.cpp output formats.
+        # llama.cpp is asked not to echo the prompt; if it is echoed anyway,
+        # it is at the start, possibly after a space.
+        stripped = output.lstrip()
+        if stripped.startswith(prompt):
+            response = stripped[len(prompt):]
         else:
+            index = output.find(prompt)
             # If prompt not found, just return the output
-            response = output.strip()
+            response = output[index + len(prompt):] if index >= 0 else output
 
         # Additional cleanup for specific llama.cpp output patterns
         # Remove any trailing special tokens or formatting
-        response = response.replace("<end>", "").replace("<eos>", "").strip()
+        response = SPECIAL_TOKENS_RE.sub("", response).strip()
 
         # If response gets truncated due to power issues, add a note
-        if (self.power_monitor and 
-                self.power_monitor.estimate_battery_level() < 25):
-            response += (
-                "\n[Note: Response may have been truncated due to low power]"
-            )
+        if battery_level is None and self.power_monitor:
+            battery_level = self.power_monitor.estimate_battery_level()
+        if battery_level is not None and battery_level < 25:
+            response += self.LOW_POWER_NOTE
 
         return response
 
-    def determine_max_tokens(self) -> int:
+    def determine_max_tokens(self, battery_level: Optional[float] = None) -> int:
         """Determine maximum response length based on power availability.
 
+        Args:
+            battery_level: Current battery level, if already known
+
         Returns:
             int: Maximum number of tokens to generate
         """
         if not self.power_monitor:
             return 1024  # Default if no power monitor
 
-        battery_level = self.power_monitor.estimate_battery_level()
+        if battery_level is None:
+            battery_level = self.power_monitor.estimate_battery_level()
 
-        if battery_level > 80:
-            return 2048  # Full responses when battery is high
-        elif battery_level > 50:
-            return 1024  # Medium responses
-        elif battery_level > 30:
-            return 512   # Short responses when power is low
-        else:
-            return 256   # Very short responses when power is critical
+        # Full responses when the battery is high, shorter as it runs down
+        return MAX_TOKENS_BY_BATTERY[
+            bisect.bisect_left(MAX_TOKENS_BATTERY_THRESHOLDS, battery_level)
+        ]
 
     def estimate_token_count(self, text: str) -> int:
         """Estimate number of tokens in text.
@@ -301,6 +530,4 @@ class LlamaProcessor(BaseLLMProcessor):
         """
         # Very simple approximation - 100 tokens is roughly 75 words
         # or about 4 characters per token on average
-        if not text:
-            return 0
-        return max(1, len(text) // 4)
\ No newline at end of file
+        return max(1, len(text) >> 2) if text else 0
\ No newline at end of file
@@ -0,0 +1,216 @@
+import json
+import logging
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from typing import Callable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Lines of server output kept to explain a failed start
+OUTPUT_TAIL_LINES = 20
+
+
+class LlamaServerTimeout(RuntimeError):
+    """The llama.cpp server stopped responding to a request."""
+
+
+class LlamaServer:
+    """
+    A llama.cpp server process that keeps the model loaded between requests.
+
+    The server is started on a local port and completions are requested over
+    its HTTP API. If the process exits, it is started again on the next request.
+    """
+
+    def __init__(
+        self,
+        server_path: str,
+        options: List[str],
+        port: int = 8081,
+        parallel: int = 1,
+        startup_timeout: float = 300.0,
+        read_timeout: float = 120.0
+    ):
+        """Initialize the server wrapper.
+
+        Args:
+            server_path: Path to the llama-server executable
+            options: Model and runtime options passed to the server
+            port: Local port the server listens on
+            parallel: Number of requests the server decodes together, with
+                continuous batching
+            startup_timeout: Seconds to wait for the model to load
+            read_timeout: Seconds to wait for the server's next output during
+                a request before giving up on it
+        """
+        self.cmd = [
+            server_path, *options,
+            "--host", "127.0.0.1",
+            "--port", str(port)
+        ]
+        if parallel > 1:
+            self.cmd += ["--parallel", str(parallel), "--cont-batching"]
+        self.parallel = parallel
+        self.url = f"http://127.0.0.1:{port}"
+        self.startup_timeout = startup_timeout
+        self.read_timeout = read_timeout
+        self.process = None
+        self._lock = threading.Lock()
+        self._output_reader = None
+        self._output_tail = deque(maxlen=OUTPUT_TAIL_LINES)
+
+    def start(self) -> None:
+        """Start the server, if it isn't running, and wait until it is ready."""
+        with self._lock:
+            if self.process is not None and self.process.poll() is None:
+                return
+
+            logger.info("Starting llama.cpp server: %s", " ".join(self.cmd))
+            # The server's log goes to the debug log, and the last lines are
+            # kept to explain a failed start, such as a bad model path
+            self._output_tail.clear()
+            self.process = subprocess.Popen(
+                self.cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT
+            )
+            self._output_reader = threading.Thread(
+                target=self._log_output, args=(self.process,),
+                name="llama_server_output", daemon=True
+            )
+            self._output_reader.start()
+            self._wait_until_ready()
+
+    def _log_output(self, process) -> None:
+        """Log the server's output until it exits, keeping the last lines."""
+        for line in process.stdout:
+            line = line.decode("utf-8", errors="replace").rstrip()
+            self._output_tail.append(line)
+            logger.debug("llama-server: %s", line)
+
+    def _startup_error(self, message: str) -> RuntimeError:
+        """Build a start-up error that includes the server's last output."""
+        # Let the reader catch up with output written just before exiting
+        self._output_reader.join(timeout=1)
+        if self._output_tail:
+            message += ":\n" + "\n".join(self._output_tail)
+        return RuntimeError(message)
+
+    def _wait_until_ready(self) -> None:
+        """Poll the health endpoint until the model has loaded."""
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise self._startup_error(
+                    f"llama.cpp server exited with code {self.process.returncode}"
+                )
+            try:
+                with urllib.request.urlopen(f"{self.url}/health", timeout=1):
+                    return
+            except (urllib.error.URLError, OSError):
+                # Not listening yet, or still loading the model (503)
+                time.sleep(0.5)
+
+        self.stop()
+        raise self._startup_error("Timed out waiting for the llama.cpp server to start")
+
+    def stop(self) -> None:
+        """Stop the server process."""
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    def complete(
+        self,
+        prompt: str,
+        max_tokens: int,
+        temperature: float,
+        should_stop: Optional[Callable[[], bool]] = None
+    ) -> str:
+        """Generate a completion for the prompt.
+
+        Args:
+            prompt: The input prompt text
+            max_tokens: Maximum number of tokens to generate
+            temperature: Temperature parameter for sampling
+            should_stop: Optional callback to end generation early
+
+        Returns:
+            str: The generated text, without the prompt
+        """
+        return "".join(self.stream(prompt, max_tokens, temperature, should_stop))
+
+    def stream(
+        self,
+        prompt: str,
+        max_tokens: int,
+        temperature: float,
+        should_stop: Optional[Callable[[], bool]] = None
+    ) -> Iterator[str]:
+        """Generate a completion for the prompt, yielding text as it arrives.
+
+        `should_stop` is called as tokens arrive; when it returns True the
+        connection is closed, which makes the server abandon the request.
+        Closing the generator early does the same. If the server sends
+        nothing for `read_timeout` seconds, the request is abandoned too.
+
+        Args:
+            prompt: The input prompt text
+            max_tokens: Maximum number of tokens to generate
+            temperature: Temperature parameter for sampling
+            should_stop: Optional callback to end generation early
+
+        Yields:
+            str: Pieces of the generated text, without the prompt
+
+        Raises:
+            LlamaServerTimeout: If the server stops responding
+        """
+        self.start()
+
+        body = json.dumps({
+            "prompt": prompt,
+            "n_predict": max_tokens,
+            "temperature": temperature,
+            "stream": True
+        }).encode("utf-8")
+        req = urllib.request.Request(
+            f"{self.url}/completion",
+            data=body,
+            headers={"Content-Type": "application/json"}
+        )
+
+        try:
+            with urllib.request.urlopen(req, timeout=self.read_timeout) as response:
+                for line in response:
+                    # Server-sent events: one "data: {...}" line per token
+                    if not line.startswith(b"data: "):
+                        continue
+                    event = json.loads(line[6:])
+                    content = event.get("content")
+                    if content:
+                        yield content
+                    if event.get("stop"):
+                        break
+                    if should_stop and should_stop():
+                        logger.warning("Battery low, stopping llama.cpp server generation")
+                        break
+        except socket.timeout as e:
+            raise LlamaServerTimeout(
+                f"llama.cpp server sent nothing for {self.read_timeout} seconds"
+            ) from e
+        except urllib.error.URLError as e:
+            # A timeout before the response headers arrive is wrapped
+            if isinstance(e.reason, socket.timeout):
+                raise LlamaServerTimeout(
+                    f"llama.cpp server sent nothing for {self.read_timeout} seconds"
+                ) from e
+            raise
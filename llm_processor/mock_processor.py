@@ -1,13 +1,18 @@
 import time
 import random
+import re
+import string
 from typing import Dict, Any, Optional, List
 
 from .base_processor import BaseLLMProcessor
+from .power_tracker import ProcessingPowerTracker
 
 
 class MockLLMProcessor(BaseLLMProcessor):
     """Mock LLM processor for testing without real LLM."""
     
+    __slots__ = ("power_monitor", "processing_speed", "canned_responses", "_canned_re", "_power_tracker")
+    
     def __init__(self, power_monitor=None, processing_speed: int = 10):
         """Initialize the mock LLM processor.
         
@@ -17,6 +22,8 @@ class MockLLMProcessor(BaseLLMProcessor):
         """
         self.power_monitor = power_monitor
         self.processing_speed = processing_speed
+        # Shared by overlapping requests, when a subclass batches them
+        self._power_tracker = ProcessingPowerTracker(power_monitor) if power_monitor else None
         
         # Pre-defined responses for testing
         self.canned_responses = {
@@ -25,6 +32,12 @@ class MockLLMProcessor(BaseLLMProcessor):
             "weather": "I don't have access to weather information.",
             "help": "I'm a simulated LLM processor for testing the solar-powered LLM system."
         }
+        # Find all of the keywords in one case-insensitive pass over the
+        # prompt; the lookahead also finds keywords overlapping each other
+        self._canned_re = re.compile(
+            "(?=(%s))" % "|".join(re.escape(key) for key in self.canned_responses),
+            re.IGNORECASE
+        )
     
     def generate_response(self, prompt: str, max_tokens: Optional[int] = None) -> str:
         """Generate a mock response to the prompt.
@@ -46,67 +59,60 @@ class MockLLMProcessor(BaseLLMProcessor):
             max_tokens = self.determine_max_tokens()
         
         # Check for canned responses
-        for key, response in self.canned_responses.items():
-            if key in prompt.lower():
-                canned_response = response
-                # Truncate if necessary
-                if len(canned_response.split()) > max_tokens:
-                    words = canned_response.split()[:max_tokens]
-                    canned_response = " ".join(words) + "..."
-                
-                # Simulate processing time
-                estimated_tokens = len(canned_response.split())
-                processing_time = estimated_tokens / self.processing_speed
-                
-                # Simulate power consumption during processing if power monitor is available
-                start_time = time.time()
-                if self.power_monitor:
-                    self.power_monitor.set_processing_state(True)
-                
-                # Simulate processing
-                time.sleep(processing_time)
-                
-                # End processing simulation
-                if self.power_monitor:
-                    elapsed_time = time.time() - start_time
-                    # Assume 5W during processing
-                    self.power_monitor.simulate_battery_change(elapsed_time, 5.0)
-                    self.power_monitor.set_processing_state(False)
-                
-                return canned_response
+        # The first keyword in dict order wins, wherever it is in the prompt
+        found = {match.group(1).lower() for match in self._canned_re.finditer(prompt)}
+        if found:
+            key = next(key for key in self.canned_responses if key in found)
+            canned_response = self.canned_responses[key]
+            # Truncate if necessary
+            if len(canned_response.split()) > max_tokens:
+                words = canned_response.split()[:max_tokens]
+                canned_response = " ".join(words) + "..."
+            
+            # Simulate processing time
+            estimated_tokens = len(canned_response.split())
+            processing_time = estimated_tokens / self.processing_speed
+            
+            self._simulate_processing(processing_time)
+            
+            return canned_response
         
         # If no canned response, generate a generic one
         response_length = min(max_tokens, random.randint(20, 50))
         
-        # Generate nonsense words for testing
+        # Generate nonsense words for testing, drawing all the word lengths
+        # and letters at once and slicing the words out of them
+        word_lengths = random.choices(range(3, 11), k=response_length)
+        letters = "".join(random.choices(string.ascii_lowercase, k=sum(word_lengths)))
         words = []
-        for _ in range(response_length):
-            word_length = random.randint(3, 10)
-            word = ''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(word_length))
-            words.append(word)
+        end = 0
+        for word_length in word_lengths:
+            words.append(letters[end:end + word_length])
+            end += word_length
         
         response = " ".join(words)
         
         # Simulate processing time
         processing_time = response_length / self.processing_speed
         
-        # Simulate power consumption during processing if power monitor is available
-        start_time = time.time()
-        if self.power_monitor:
-            self.power_monitor.set_processing_state(True)
-        
-        # Simulate processing
-        time.sleep(processing_time)
-        
-        # End processing simulation
-        if self.power_monitor:
-            elapsed_time = time.time() - start_time
-            # Assume 5W during processing
-            self.power_monitor.simulate_battery_change(elapsed_time, 5.0)
-            self.power_monitor.set_processing_state(False)
+        self._simulate_processing(processing_time)
         
         return f"Mock response to: {prompt[:30]}... \n\n{response}"
     
+    def _simulate_processing(self, processing_time: float) -> None:
+        """Wait out the processing time, drawing power if there is a power monitor."""
+        if not self._power_tracker:
+            time.sleep(processing_time)
+            return
+        
+        # Assume 5W during processing, charged once while requests overlap
+        started = self._power_tracker.start()
+        try:
+            time.sleep(processing_time)
+            self._power_tracker.charge(started)
+        finally:
+            self._power_tracker.finish()
+    
     def determine_max_tokens(self) -> int:
         """Determine maximum response length based on power availability."""
         if not self.power_monitor:
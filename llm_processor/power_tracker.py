@@ -0,0 +1,55 @@
+import threading
+import time
+
+
+class ProcessingPowerTracker:
+    """
+    Tracks the requests a processor is generating against its power monitor.
+
+    Requests overlap when the processor batches them. The monitor stays in
+    the processing state while any of them is in progress, and the simulated
+    battery drain is charged once for each stretch of wall-clock time, however
+    many requests shared it.
+    """
+
+    def __init__(self, power_monitor, processing_power: float = 5.0):
+        """Initialize the tracker.
+
+        Args:
+            power_monitor: Power monitor to report processing and drain to
+            processing_power: Power drawn while processing, in Watts
+        """
+        self.power_monitor = power_monitor
+        self.processing_power = processing_power
+        self._lock = threading.Lock()
+        self._active = 0
+        # Monotonic time up to which drain has already been charged
+        self._charged_until = 0.0
+
+    def start(self) -> float:
+        """Record that a request started.
+
+        Returns:
+            float: The request's monotonic start time, to pass to charge()
+        """
+        with self._lock:
+            if self._active == 0:
+                self.power_monitor.set_processing_state(True)
+            self._active += 1
+            return time.monotonic()
+
+    def charge(self, started: float) -> None:
+        """Charge the drain of a request so far, skipping time already charged."""
+        with self._lock:
+            now = time.monotonic()
+            since = max(started, self._charged_until)
+            if now > since:
+                self.power_monitor.simulate_battery_change(now - since, self.processing_power)
+                self._charged_until = now
+
+    def finish(self) -> None:
+        """Record that a request ended, leaving the processing state after the last."""
+        with self._lock:
+            self._active -= 1
+            if self._active == 0:
+                self.power_monitor.set_processing_state(False)
@@ -1,5 +1,13 @@
 from .base_monitor import BasePowerMonitor
 from .mock_monitor import MockPowerMonitor
-from .tc66_monitor import TC66PowerMonitor
 
-__all__ = ['BasePowerMonitor', 'MockPowerMonitor', 'TC66PowerMonitor']
\ No newline at end of file
+__all__ = ['BasePowerMonitor', 'MockPowerMonitor', 'TC66PowerMonitor']
+
+
+def __getattr__(name):
+    # TC66PowerMonitor needs pyserial and pycryptodome, so only import it
+    # when it's asked for; mock-only setups don't need those installed
+    if name == 'TC66PowerMonitor':
+        from .tc66_monitor import TC66PowerMonitor
+        return TC66PowerMonitor
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -6,6 +6,9 @@ from typing import Dict, List, Any, Optional
 class BasePowerMonitor(ABC):
     """Base class for power monitoring implementations."""
     
+    # Short name reported by the API for this kind of monitor
+    MONITOR_TYPE = "unknown"
+    
     @abstractmethod
     def get_current_power_reading(self) -> Dict[str, Any]:
         """Read current power data.
@@ -78,4 +81,13 @@ class BasePowerMonitor(ABC):
             - temperature: float (Celsius)
             - timestamp: int (Unix timestamp)
         """
-        pass
\ No newline at end of file
+        pass
+    
+    def get_full_snapshot(self) -> Dict[str, Any]:
+        """Get the current power reading and status combined in one dict.
+        
+        Returns:
+            Dict with the keys of both get_current_power_reading() and
+            get_current_status(), status values taking precedence
+        """
+        return {**self.get_current_power_reading(), **self.get_current_status()}
@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+class PowerHistoryStore:
+    """SQLite storage for the learned solar output of each hour of the day.
+
+    Each update writes a single row, instead of rewriting the whole history.
+    """
+
+    def __init__(self, db_path: str = "db/power_history.db"):
+        """Initialize the store.
+
+        Args:
+            db_path: Path to the SQLite database file
+        """
+        self.db_path = db_path
+        self._local = threading.local()
+        self.init_db()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """Get this thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def init_db(self) -> None:
+        """Create the solar pattern table if it doesn't exist."""
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        with self._get_connection() as conn:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS solar_pattern (
+                hour INTEGER PRIMARY KEY,
+                ewma REAL
+            )
+            ''')
+
+    def load_solar_patterns(self) -> Dict[str, float]:
+        """Get the solar output pattern, keyed by hour as a string."""
+        rows = self._get_connection().execute(
+            "SELECT hour, ewma FROM solar_pattern"
+        ).fetchall()
+        return {str(hour): ewma for hour, ewma in rows}
+
+    def set_solar_pattern(self, hour: int, value: float) -> None:
+        """Store the solar output pattern for one hour of the day."""
+        with self._get_connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO solar_pattern (hour, ewma) VALUES (?, ?)",
+                (hour, value)
+            )
+
+    def import_json_history(self, history_file: str) -> bool:
+        """Import the solar patterns of a JSON power history file.
+
+        Only imports into an empty store, so it can run on every start.
+
+        Args:
+            history_file: Path to the JSON history file
+
+        Returns:
+            bool: True if patterns were imported
+        """
+        if not os.path.exists(history_file) or self.load_solar_patterns():
+            return False
+
+        try:
+            with open(history_file, "r") as f:
+                patterns = json.load(f)["daily_solar_patterns"]
+        except Exception as e:
+            logger.error(f"Error importing power history: {e}")
+            return False
+
+        with self._get_connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO solar_pattern (hour, ewma) VALUES (?, ?)",
+                [(int(hour), value) for hour, value in patterns.items()]
+            )
+        logger.info(f"Imported power history from {history_file}")
+        return True
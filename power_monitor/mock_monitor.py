@@ -9,6 +9,8 @@ from .base_monitor import BasePowerMonitor
 class MockPowerMonitor(BasePowerMonitor):
     """Mock power monitor for testing with simulated solar power and battery."""
     
+    MONITOR_TYPE = "mock"
+    
     def __init__(self, 
                  initial_battery_level: float = 75.0,
                  max_solar_output: float = 30.0,
@@ -30,6 +32,22 @@ class MockPowerMonitor(BasePowerMonitor):
         
     def get_current_power_reading(self) -> Dict[str, Any]:
         """Get simulated power readings."""
+        solar_output = self._simulated_solar_output()
+            
+        # Calculate simulated consumption
+        power_consumption = self.processing_consumption if self.is_processing else self.base_consumption
+        
+        return {
+            "timestamp": int(time.time()),
+            "voltage": 3.7 + (self.battery_level / 100 * 0.8),  # 3.7-4.5V range
+            "current": 1.0 if self.is_processing else 0.4,  # A
+            "power": solar_output,
+            "consumption": power_consumption,
+            "temperature": 25 + random.uniform(-2, 2)  # Slight temperature variance
+        }
+    
+    def _simulated_solar_output(self) -> float:
+        """Simulate the current solar output in Watts."""
         current_hour = datetime.now().hour
         
         # Force a minimum non-zero solar output for debugging purposes
@@ -45,19 +63,7 @@ class MockPowerMonitor(BasePowerMonitor):
             solar_output = min_solar_output
             
         # Ensure we have at least the minimum output
-        solar_output = max(solar_output, min_solar_output)
-            
-        # Calculate simulated consumption
-        power_consumption = self.processing_consumption if self.is_processing else self.base_consumption
-        
-        return {
-            "timestamp": int(time.time()),
-            "voltage": 3.7 + (self.battery_level / 100 * 0.8),  # 3.7-4.5V range
-            "current": 1.0 if self.is_processing else 0.4,  # A
-            "power": solar_output,
-            "consumption": power_consumption,
-            "temperature": 25 + random.uniform(-2, 2)  # Slight temperature variance
-        }
+        return max(solar_output, min_solar_output)
     
     def estimate_battery_level(self) -> float:
         """Return the current simulated battery level."""
@@ -65,7 +71,7 @@ class MockPowerMonitor(BasePowerMonitor):
     
     def get_solar_output(self) -> float:
         """Get current simulated solar panel output."""
-        return self.get_current_power_reading()["power"]
+        return self._simulated_solar_output()
     
     def predict_future_availability(self, hours_ahead: int = 24) -> List[Dict[str, Any]]:
         """Predict power availability for upcoming hours."""
@@ -106,16 +112,22 @@ class MockPowerMonitor(BasePowerMonitor):
     
     def can_process_request(self, estimated_power_requirement: float) -> bool:
         """Determine if there's enough power to process a request."""
-        current_reading = self.get_current_power_reading()
         battery_level = self.battery_level
         
         # Simple rule: we need at least 30% battery and more solar input than the requirement
-        return battery_level > 30 and current_reading["power"] > estimated_power_requirement
+        return battery_level > 30 and self._simulated_solar_output() > estimated_power_requirement
     
     def get_current_status(self) -> Dict[str, Any]:
         """Get complete power status information."""
+        return self._status_from_reading(self.get_current_power_reading())
+    
+    def get_full_snapshot(self) -> Dict[str, Any]:
+        """Get the current power reading and status from a single simulated reading."""
         readings = self.get_current_power_reading()
-        
+        return {**readings, **self._status_from_reading(readings)}
+    
+    def _status_from_reading(self, readings: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the status dict for a power reading."""
         return {
             "battery_level": self.battery_level,
             "solar_output": readings["power"],
@@ -1,22 +1,23 @@
 import time
-import json
-import os
+import sqlite3
 import threading
+from collections import deque
 from datetime import datetime
 from typing import Dict, List, Any, Optional, Union
 import logging
 
 from .base_monitor import BasePowerMonitor
+from .history_store import PowerHistoryStore
 from utils.monitor import TC66Monitor
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
 class TC66PowerMonitor(BasePowerMonitor):
     """Power monitor implementation using TC66 USB-C power meter data."""
     
+    MONITOR_TYPE = "tc66"
+    
     def __init__(self, 
                  serial_port: str = '/dev/ttyACM0',
                  battery_capacity: float = 10000.0,  # mAh
@@ -24,7 +25,8 @@ class TC66PowerMonitor(BasePowerMonitor):
                  initial_battery_level: float = 75.0,
                  base_consumption: float = 2.0,
                  max_solar_output: float = 30.0,
-                 power_reading_cache_time: int = 5):  # seconds
+                 power_reading_cache_time: int = 5,  # seconds
+                 background_reads: bool = True):
         """Initialize the TC66 power monitor.
         
         Args:
@@ -35,6 +37,8 @@ class TC66PowerMonitor(BasePowerMonitor):
             base_consumption: Base system power consumption in Watts
             max_solar_output: Maximum expected solar panel output in Watts
             power_reading_cache_time: How long to cache power readings in seconds
+            background_reads: Read the TC66 on a background thread, so callers
+                get the latest reading without waiting on the serial port
         """
         self.serial_port = serial_port
         self.battery_capacity = battery_capacity
@@ -55,6 +59,13 @@ class TC66PowerMonitor(BasePowerMonitor):
         self.last_reading_time = 0
         self.power_reading_cache_time = power_reading_cache_time
         
+        # (reading, value) of the battery level and solar output derived from
+        # the cached reading, so status polls within the cache window don't
+        # recompute them. Each pair is replaced in one assignment, so the
+        # background reader never sees a value paired with the wrong reading
+        self._battery_level_cache = (None, None)
+        self._solar_output_cache = (None, None)
+        
         # Store battery level for fallback when readings fail
         self.stored_battery_level = initial_battery_level
         
@@ -62,16 +73,27 @@ class TC66PowerMonitor(BasePowerMonitor):
         self.connect()
 
         # Recent readings for estimating trends
-        self.recent_readings = []
         self.max_recent_readings = 10
+        self.recent_readings = deque(maxlen=self.max_recent_readings)
         
-        # History file for solar output and battery trends
+        # Learned solar output per hour, persisted in SQLite; the JSON file
+        # used by older versions is imported once
         self.history_file = "power_history.json"
+        self.history_store = PowerHistoryStore()
+        self.history_store.import_json_history(self.history_file)
         self.power_history = self.load_power_history()
         
         # Lock for thread safety
         self.lock = threading.Lock()
         
+        # Only one thread talks to the serial port at a time
+        self._serial_lock = threading.Lock()
+        self._stop_reader = threading.Event()
+        self._reader = None
+        if background_reads:
+            self._reader = threading.Thread(target=self._reader_loop, name="tc66-reader", daemon=True)
+            self._reader.start()
+        
     def connect(self) -> bool:
         """Connect to the TC66 device."""
         try:
@@ -86,34 +108,19 @@ class TC66PowerMonitor(BasePowerMonitor):
             return False
     
     def load_power_history(self) -> Dict[str, Any]:
-        """Load power history from file or create default."""
-        default_history = {
+        """Load power history from the history store."""
+        history = {
             "daily_solar_patterns": {str(h): 0.0 for h in range(24)},
             "battery_discharge_rate": 0.5,  # % per hour under base load
             "last_updated": time.time()
         }
         
-        if not os.path.exists(self.history_file):
-            return default_history
-            
         try:
-            with open(self.history_file, "r") as f:
-                history = json.load(f)
-                return history
-        except Exception as e:
+            history["daily_solar_patterns"].update(self.history_store.load_solar_patterns())
+        except sqlite3.Error as e:
             logger.error(f"Error loading power history: {e}")
-            return default_history
-    
-    def save_power_history(self) -> None:
-        """Save power history to file."""
-        try:
-            # Update last updated timestamp
-            self.power_history["last_updated"] = time.time()
-            
-            with open(self.history_file, "w") as f:
-                json.dump(self.power_history, f)
-        except Exception as e:
-            logger.error(f"Error saving power history: {e}")
+        
+        return history
     
     def update_power_history(self, reading: Dict[str, Any]) -> None:
         """Update power history with new reading."""
@@ -129,13 +136,16 @@ class TC66PowerMonitor(BasePowerMonitor):
             if hour_key in self.power_history["daily_solar_patterns"]:
                 old_value = self.power_history["daily_solar_patterns"][hour_key]
                 new_value = old_value * 0.95 + solar_output * 0.05
-                self.power_history["daily_solar_patterns"][hour_key] = new_value
             else:
-                self.power_history["daily_solar_patterns"][hour_key] = solar_output
+                new_value = solar_output
+            self.power_history["daily_solar_patterns"][hour_key] = new_value
+            self.power_history["last_updated"] = time.time()
             
-            # Save every 10 readings
-            if len(self.recent_readings) % 10 == 0:
-                self.save_power_history()
+            # Persist just this hour's value
+            try:
+                self.history_store.set_solar_pattern(current_hour, new_value)
+            except sqlite3.Error as e:
+                logger.error(f"Error saving power history: {e}")
     
     def get_current_power_reading(self) -> Dict[str, Any]:
         """Get current power reading from TC66.
@@ -143,11 +153,52 @@ class TC66PowerMonitor(BasePowerMonitor):
         Returns:
             Dict with power data or fallback values if unable to read
         """
-        # Check if we can use cached reading
-        current_time = time.time()
+        reading = self._fresh_reading()
+        if reading is not None:
+            return reading
+        
+        # If the background reader is mid-read, wait for its result rather
+        # than reading the port again
+        with self._serial_lock:
+            reading = self._fresh_reading()
+            if reading is not None:
+                return reading
+            return self._read_power()
+    
+    def _fresh_reading(self) -> Optional[Dict[str, Any]]:
+        """Get the cached reading, if it is recent enough to use."""
         if (self.last_reading is not None and 
-            current_time - self.last_reading_time < self.power_reading_cache_time):
+            time.time() - self.last_reading_time < self.power_reading_cache_time):
             return self.last_reading
+        return None
+    
+    def _reader_loop(self) -> None:
+        """Keep the cached reading fresh until the monitor is closed."""
+        # Refresh twice per cache period so callers rarely find it expired
+        interval = max(1.0, self.power_reading_cache_time / 2)
+        while True:
+            with self._serial_lock:
+                try:
+                    self._read_power()
+                except Exception as e:
+                    logger.error(f"Error in TC66 background read: {e}")
+            if self._stop_reader.wait(interval):
+                return
+    
+    def close(self) -> None:
+        """Stop background reads and disconnect from the TC66."""
+        self._stop_reader.set()
+        if self._reader is not None:
+            self._reader.join()
+        with self._serial_lock:
+            self.tc66.disconnect()
+    
+    def _read_power(self) -> Dict[str, Any]:
+        """Read the TC66, falling back to cached or estimated values.
+        
+        Must be called with the serial lock held.
+        """
+        current_time = time.time()
         
         # Variable to track if we need to attempt reconnection
         reconnect_needed = False
@@ -174,8 +225,6 @@ class TC66PowerMonitor(BasePowerMonitor):
                 # Update recent readings
                 with self.lock:
                     self.recent_readings.append(reading)
-                    if len(self.recent_readings) > self.max_recent_readings:
-                        self.recent_readings.pop(0)
                 
                 # Update power history
                 self.update_power_history(reading)
@@ -226,12 +275,15 @@ class TC66PowerMonitor(BasePowerMonitor):
         
         # Fallback if reading failed
         if self.last_reading is not None:
-            # Use last successful reading but with updated timestamp and consumption
-            fallback = self.last_reading.copy()
-            fallback["timestamp"] = int(current_time)
-            
-            # Update consumption based on current processing state
-            fallback["consumption"] = self.base_consumption if not self.is_processing else 5.0
+            # Use last successful reading but with updated timestamp and
+            # consumption based on current processing state. It's built as a
+            # new dict because the last reading is shared with other callers
+            # and the recent readings
+            fallback = {
+                **self.last_reading,
+                "timestamp": int(current_time),
+                "consumption": self.base_consumption if not self.is_processing else 5.0
+            }
             
             # Make sure power (solar output) is maintained from the last reading
             # We don't want it to drop to zero during processing
@@ -257,10 +309,24 @@ class TC66PowerMonitor(BasePowerMonitor):
     
     def estimate_battery_level(self) -> float:
         """Estimate battery level based on voltage and usage history."""
-        # Get current reading
-        reading = self.get_current_power_reading()
-        voltage = reading["voltage"]
+        return self._battery_level_from_reading(self.get_current_power_reading())
+    
+    def _battery_level_from_reading(self, reading: Dict[str, Any]) -> float:
+        """Estimate battery level from the voltage of a power reading."""
+        cached_reading, cached_level = self._battery_level_cache
+        if reading is cached_reading:
+            return cached_level
         
+        battery_level = self._estimate_battery_level_from_voltage(reading["voltage"])
+        
+        # Only the cached reading is handed out more than once
+        if reading is self.last_reading:
+            self._battery_level_cache = (reading, battery_level)
+        
+        return battery_level
+    
+    def _estimate_battery_level_from_voltage(self, voltage: float) -> float:
+        """Estimate battery level from a battery voltage."""
         # Check if voltage seems too low (could be a failed reading)
         if voltage < 0.1:
             # If we have a known battery level, just return that
@@ -290,8 +356,25 @@ class TC66PowerMonitor(BasePowerMonitor):
     
     def get_solar_output(self) -> float:
         """Get current solar panel output in Watts."""
+        return self._solar_output_from_reading(self.get_current_power_reading())
+    
+    def _solar_output_from_reading(self, reading: Dict[str, Any]) -> float:
+        """Get the solar output for a power reading."""
+        cached_reading, cached_output = self._solar_output_cache
+        if reading is cached_reading:
+            return cached_output
+        
+        solar_output = self._estimate_solar_output(reading)
+        
+        # Only the cached reading is handed out more than once
+        if reading is self.last_reading:
+            self._solar_output_cache = (reading, solar_output)
+        
+        return solar_output
+    
+    def _estimate_solar_output(self, reading: Dict[str, Any]) -> float:
+        """Get the solar output for a power reading, estimating it if missing."""
         # The power reading from TC66 is the current solar output
-        reading = self.get_current_power_reading()
         solar_output = reading["power"]
         
         # If power is zero or very low (possibly due to reading error)
@@ -327,14 +410,16 @@ class TC66PowerMonitor(BasePowerMonitor):
         current_hour = datetime.now().hour
         current_battery = self.battery_level
         
+        # Loop invariants: the solar estimate only depends on the hour of day
+        solar_by_hour = [self.estimate_solar_output_for_hour(h) for h in range(24)]
+        consumption_estimate = self.base_consumption
+        percent_per_wh = 100 / self.battery_capacity_wh
+        
         for hour in range(hours_ahead):
             forecast_hour = (current_hour + hour) % 24
             
             # Get solar estimate for this hour
-            solar_estimate = self.estimate_solar_output_for_hour(forecast_hour)
-            
-            # Estimate power consumption
-            consumption_estimate = self.base_consumption
+            solar_estimate = solar_by_hour[forecast_hour]
             
             # Calculate net power flow
             net_power = solar_estimate - consumption_estimate
@@ -343,11 +428,10 @@ class TC66PowerMonitor(BasePowerMonitor):
             if net_power > 0:
                 # Charging: reduced efficiency as battery fills up
                 charge_efficiency = 0.85 - (0.2 * current_battery / 100)
-                energy_in = net_power * charge_efficiency
-                battery_change = (energy_in / self.battery_capacity_wh) * 100
+                battery_change = net_power * charge_efficiency * percent_per_wh
             else:
                 # Discharging
-                battery_change = (net_power / self.battery_capacity_wh) * 100
+                battery_change = net_power * percent_per_wh
             
             # Update battery level for next hour
             current_battery += battery_change
@@ -357,16 +441,17 @@ class TC66PowerMonitor(BasePowerMonitor):
                 "hour": forecast_hour,
                 "solar_output": solar_estimate,
                 "battery_level": current_battery,
-                "processing_capable": current_battery > 30 and solar_estimate > self.base_consumption
+                "processing_capable": current_battery > 30 and solar_estimate > consumption_estimate
             })
             
         return predictions
     
     def can_process_request(self, estimated_power_requirement: float) -> bool:
         """Determine if there's enough power to process a request."""
-        # Get current readings
-        battery_level = self.estimate_battery_level()
-        solar_output = self.get_solar_output()
+        # Get current readings, from a single TC66 reading
+        reading = self.get_current_power_reading()
+        battery_level = self._battery_level_from_reading(reading)
+        solar_output = self._solar_output_from_reading(reading)
         
         # Determine if we have enough power
         # Require at least 30% battery and either:
@@ -377,8 +462,16 @@ class TC66PowerMonitor(BasePowerMonitor):
     
     def get_current_status(self) -> Dict[str, Any]:
         """Get complete power status information."""
+        return self._status_from_reading(self.get_current_power_reading())
+    
+    def get_full_snapshot(self) -> Dict[str, Any]:
+        """Get the current power reading and status from a single TC66 reading."""
         readings = self.get_current_power_reading()
-        battery_level = self.estimate_battery_level()
+        return {**readings, **self._status_from_reading(readings)}
+    
+    def _status_from_reading(self, readings: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the status dict for a power reading."""
+        battery_level = self._battery_level_from_reading(readings)
         
         return {
             "battery_level": battery_level,
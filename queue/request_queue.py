@@ -1,59 +1,133 @@
+import logging
+import secrets
 import sqlite3
-import uuid
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
+# Statement texts are reused verbatim so SQLite's statement cache can skip re-parsing
+_SQL_INSERT = "INSERT INTO requests VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+_SQL_GET = "SELECT * FROM requests WHERE id = ?"
+_SQL_UPDATE_STATUS = "UPDATE requests SET status = ? WHERE id = ?"
+_SQL_UPDATE_STATUS_RESPONSE = "UPDATE requests SET status = ?, response = ? WHERE id = ?"
+_SQL_CONVERSATION = "SELECT * FROM requests WHERE conversation_id = ? ORDER BY submitted_at ASC"
+
+# How long polled reads may be served from memory; writes made through this
+# queue invalidate them straight away, so this only bounds how long writes
+# from another process can go unseen
+READ_CACHE_TTL = 0.5
 
 class RequestQueue:
     def __init__(self, db_path="db/queue.db"):
         self.db_path = db_path
+        self._local = threading.local()
+        # Cached reads are tagged with the write version they were read at
+        self._version = 0
+        self._queue_length_cache = (-1, 0.0, 0)
+        self._request_cache = {}
         self.init_db()
         
+    def _get_connection(self):
+        """Get this thread's connection, opening and configuring it on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA cache_size=-64000")
+            # Keep sort scratch space in memory and read pages through mmap
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA mmap_size=67108864")
+            self._local.conn = conn
+        return conn
+    
+    @contextmanager
+    def writer(self):
+        """Use this thread's connection for a write transaction
+        
+        The transaction is committed on success and rolled back on error, so a
+        failed write never leaves the long-lived connection holding the lock.
+        """
+        conn = self._get_connection()
+        with conn:
+            yield conn
+        self._invalidate_cache()
+    
+    def _invalidate_cache(self):
+        """Drop cached reads after a write"""
+        self._version += 1
+        self._request_cache = {}
+    
+    def _cache_fresh(self, version, cached_at):
+        """Whether a cached read is still valid"""
+        return version == self._version and time.monotonic() - cached_at < READ_CACHE_TTL
+        
     def init_db(self):
         """Initialize SQLite database for persistent queue storage"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Create requests table if it doesn't exist
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS requests (
-            id TEXT PRIMARY KEY,
-            conversation_id TEXT,
-            prompt TEXT,
-            submitted_at TEXT,
-            estimated_power REAL,
-            estimated_completion TEXT,
-            status TEXT,
-            response TEXT
-        )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        with self.writer() as conn:
+            # Create requests table if it doesn't exist
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS requests (
+                id TEXT PRIMARY KEY,
+                conversation_id TEXT,
+                prompt TEXT,
+                submitted_at TEXT,
+                estimated_power REAL,
+                estimated_completion TEXT,
+                status TEXT,
+                response TEXT
+            )
+            ''')
+            # The scheduler looks up the oldest queued request on every tick,
+            # and conversation pages list a conversation's requests in order
+            conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_requests_queued
+            ON requests (status, submitted_at, estimated_power, estimated_completion)
+            ''')
+            conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_requests_conversation
+            ON requests (conversation_id, submitted_at)
+            ''')
         
     def enqueue(self, conversation_id, prompt, estimated_power, estimated_completion):
         """Add a request to the queue"""
-        request_id = str(uuid.uuid4())
+        return self.enqueue_many([
+            (conversation_id, prompt, estimated_power, estimated_completion)
+        ])[0]
+    
+    def enqueue_many(self, requests):
+        """Add several requests to the queue in a single transaction
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        Args:
+            requests: Iterable of (conversation_id, prompt, estimated_power,
+                estimated_completion) tuples
+            
+        Returns:
+            List of the new request IDs, in the same order
+        """
+        submitted_at = datetime.now().isoformat()
+        rows = [
+            (
+                secrets.token_hex(16),
+                conversation_id,
+                prompt,
+                submitted_at,
+                estimated_power,
+                estimated_completion.isoformat(),
+                "queued",
+                None
+            )
+            for conversation_id, prompt, estimated_power, estimated_completion in requests
+        ]
         
-        cursor.execute('''
-        INSERT INTO requests VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            request_id,
-            conversation_id,
-            prompt,
-            datetime.now().isoformat(),
-            estimated_power,
-            estimated_completion.isoformat(),
-            "queued",
-            None
-        ))
-        
-        conn.commit()
-        conn.close()
-        
-        return request_id
+        with self.writer() as conn:
+            conn.executemany(_SQL_INSERT, rows)
+        
+        return [row[0] for row in rows]
         
     def get_next_processable_request(self, available_power, immediate_mode=False):
         """Find first request that can be processed with available power
@@ -65,33 +139,18 @@ class RequestQueue:
         Returns:
             Next request that can be processed or None
         """
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        conn = self._get_connection()
         cursor = conn.cursor()
         
         now = datetime.now().isoformat()
-        print(f"[DEBUG] Queue: Looking for next request (immediate_mode={immediate_mode}, available_power={available_power}W)")
         
-        # First, get all queued requests for debugging
-        cursor.execute('''
-        SELECT id, estimated_power, estimated_completion, submitted_at
-        FROM requests 
-        WHERE status = 'queued'
-        ORDER BY submitted_at ASC
-        ''')
-        
-        queued_requests = cursor.fetchall()
-        print(f"[DEBUG] Queue: Found {len(queued_requests)} queued requests")
-        for req in queued_requests:
-            print(f"[DEBUG] Queue: Queued request id={req['id']}, power={req['estimated_power']}W, scheduled_time={req['estimated_completion']}")
-            if req['estimated_power'] > available_power:
-                print(f"[DEBUG] Queue:   - Not enough power (need {req['estimated_power']}W, have {available_power}W)")
-            if not immediate_mode and req['estimated_completion'] > now:
-                print(f"[DEBUG] Queue:   - Not scheduled yet (scheduled for {req['estimated_completion']})")
+        # Listing why each queued request is waiting reads the whole queue,
+        # so only do it when it will be logged
+        if logger.isEnabledFor(logging.DEBUG):
+            self._log_queued_requests(available_power, immediate_mode, now)
         
         if immediate_mode:
             # In immediate mode, process regardless of power requirements if battery is good
-            print("[DEBUG] Queue: Using immediate mode query (ignoring scheduled time and power requirements)")
             cursor.execute('''
             SELECT * FROM requests 
             WHERE status = 'queued'
@@ -100,7 +159,6 @@ class RequestQueue:
             ''')
         else:
             # In normal mode, also check if it's time to process (estimated_completion <= now)
-            print("[DEBUG] Queue: Using normal mode query (checking scheduled time)")
             cursor.execute('''
             SELECT * FROM requests 
             WHERE status = 'queued' AND estimated_power <= ? 
@@ -110,95 +168,125 @@ class RequestQueue:
             ''', (available_power, now))
         
         row = cursor.fetchone()
-        conn.close()
         
         if row:
-            print(f"[DEBUG] Queue: Found processable request id={row['id']}")
+            logger.debug("Found processable request id=%s", row['id'])
             return dict(row)
             
-        print("[DEBUG] Queue: No processable requests found")
+        logger.debug("No processable requests found")
         return None
     
+    def _log_queued_requests(self, available_power, immediate_mode, now):
+        """Log each queued request and why it can't be processed yet"""
+        rows = self._get_connection().execute('''
+        SELECT id, estimated_power, estimated_completion, submitted_at
+        FROM requests 
+        WHERE status = 'queued'
+        ORDER BY submitted_at ASC
+        ''').fetchall()
+        
+        logger.debug("Looking for next request (immediate_mode=%s, available_power=%sW), %d queued",
+                     immediate_mode, available_power, len(rows))
+        for req in rows:
+            logger.debug("Queued request id=%s, power=%sW, scheduled_time=%s",
+                         req['id'], req['estimated_power'], req['estimated_completion'])
+            if req['estimated_power'] > available_power:
+                logger.debug("  - Not enough power (need %sW, have %sW)", req['estimated_power'], available_power)
+            if not immediate_mode and req['estimated_completion'] > now:
+                logger.debug("  - Not scheduled yet (scheduled for %s)", req['estimated_completion'])
+    
     def update_request_status(self, request_id, status, response=None):
         """Update the status of a request"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        if response:
-            cursor.execute('''
-            UPDATE requests SET status = ?, response = ? WHERE id = ?
-            ''', (status, response, request_id))
-        else:
-            cursor.execute('''
-            UPDATE requests SET status = ? WHERE id = ?
-            ''', (status, request_id))
-        
-        conn.commit()
-        conn.close()
+        with self.writer() as conn:
+            if response:
+                conn.execute(_SQL_UPDATE_STATUS_RESPONSE, (status, response, request_id))
+            else:
+                conn.execute(_SQL_UPDATE_STATUS, (status, request_id))
     
     def get_request(self, request_id):
         """Get a request by ID"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        cached = self._request_cache.get(request_id)
+        if cached and self._cache_fresh(cached[0], cached[1]):
+            # Callers add fields to the result, so hand out a copy
+            return dict(cached[2])
+        
+        version = self._version
+        conn = self._get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('SELECT * FROM requests WHERE id = ?', (request_id,))
+        cursor.execute(_SQL_GET, (request_id,))
         row = cursor.fetchone()
         
-        conn.close()
-        
         if row:
-            return dict(row)
+            request = dict(row)
+            self._request_cache[request_id] = (version, time.monotonic(), request)
+            return dict(request)
         return None
     
     def get_conversation_requests(self, conversation_id):
         """Get all requests for a conversation"""
         if not conversation_id:
-            print(f"[DEBUG] Queue: Cannot get conversation requests: conversation_id is {conversation_id}")
+            logger.debug("Cannot get conversation requests: conversation_id is %s", conversation_id)
             return []
             
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        print(f"[DEBUG] Queue: Getting conversation requests for ID: {conversation_id}")
-        cursor.execute('''
-        SELECT * FROM requests WHERE conversation_id = ? ORDER BY submitted_at ASC
-        ''', (conversation_id,))
+        conn = self._get_connection()
+        requests = [dict(row) for row in conn.execute(_SQL_CONVERSATION, (conversation_id,))]
         
-        rows = cursor.fetchall()
-        conn.close()
-        
-        print(f"[DEBUG] Queue: Found {len(rows)} requests for conversation {conversation_id}")
-        return [dict(row) for row in rows]
+        logger.debug("Found %d requests for conversation %s", len(requests), conversation_id)
+        return requests
     
+    def iter_conversation_requests(self, conversation_id):
+        """Yield the requests of a conversation one at a time, oldest first"""
+        if not conversation_id:
+            return
+
+        conn = self._get_connection()
+        for row in conn.execute(_SQL_CONVERSATION, (conversation_id,)):
+            yield dict(row)
+
     def get_queue_length(self):
         """Get the number of queued requests"""
-        conn = sqlite3.connect(self.db_path)
+        version, cached_at, count = self._queue_length_cache
+        if self._cache_fresh(version, cached_at):
+            return count
+        
+        version = self._version
+        conn = self._get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('SELECT COUNT(*) FROM requests WHERE status = "queued"')
+        cursor.execute("SELECT COUNT(*) FROM requests WHERE status = 'queued'")
         count = cursor.fetchone()[0]
         
-        conn.close()
+        self._queue_length_cache = (version, time.monotonic(), count)
         return count
     
+    def has_queued_requests(self):
+        """Check whether any request is waiting, without counting them all"""
+        conn = self._get_connection()
+        row = conn.execute("SELECT 1 FROM requests WHERE status = 'queued' LIMIT 1").fetchone()
+        return row is not None
+    
     def get_queue_position(self, request_id):
         """Get position of request in the queue"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
-        SELECT position FROM (
-            SELECT id as request_id, ROW_NUMBER() OVER (ORDER BY submitted_at ASC) as position 
-            FROM requests 
-            WHERE status = 'queued'
-        ) WHERE request_id = ?
+        SELECT submitted_at, rowid FROM requests WHERE id = ? AND status = 'queued'
         ''', (request_id,))
         
         row = cursor.fetchone()
-        conn.close()
         
-        if row:
-            return row[0]
-        return None
\ No newline at end of file
+        if not row:
+            return None
+        
+        # Count the queued requests ahead of it with an index range scan,
+        # instead of numbering the whole queue
+        submitted_at, rowid = row
+        cursor.execute('''
+        SELECT COUNT(*) FROM requests 
+        WHERE status = 'queued' 
+        AND submitted_at <= ? AND (submitted_at < ? OR rowid <= ?)
+        ''', (submitted_at, submitted_at, rowid))
+        
+        return cursor.fetchone()[0]
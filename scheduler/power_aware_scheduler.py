@@ -1,8 +1,9 @@
 import json
+import logging
 import os
-import sqlite3
 import threading
 import time
+from collections import deque
 from datetime import datetime, timedelta
 from typing import Dict, Any, Tuple, Optional, List, Callable
 
@@ -10,6 +11,25 @@ from queue import RequestQueue
 from power_monitor import BasePowerMonitor
 from llm_processor import BaseLLMProcessor
 
+logger = logging.getLogger(__name__)
+
+# The 24-hour power forecast barely changes from one minute to the next, so
+# bursts of enqueues share one
+FORECAST_CACHE_TTL = 60.0
+
+CALIBRATION_FILE = "power_calibration_data.json"
+# Calibration is only written to disk once a value has drifted this much
+# (relative) from what was last saved
+CALIBRATION_SAVE_THRESHOLD = 0.02
+# Requests shorter than this, in seconds or tokens, are too noisy to learn from
+MIN_CALIBRATION_SECONDS = 0.5
+MIN_CALIBRATION_TOKENS = 8
+
+# While requests keep coming, reuse a power reading for this many requests
+# or seconds before checking again
+POWER_RECHECK_REQUESTS = 8
+POWER_RECHECK_INTERVAL = 5.0
+
 
 class PowerAwareScheduler:
     """
@@ -38,17 +58,42 @@ class PowerAwareScheduler:
         self.callback_fn = callback_fn
         self.processing = False
         self.stop_processing = False
+        # Set by stop() so the processing loop wakes from its idle waits
+        self._stop_event = threading.Event()
+        # One long-lived worker runs the processing loop, and sleeps on the
+        # wake event while the queue is empty; new requests also set it to
+        # cut short the loop's wait for processable work
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._wake_event = threading.Event()
+        # Set each time a request finishes, completed or failed
+        self._completed_event = threading.Event()
+        # Requests in progress, when the LLM processor can batch several.
+        # Up to max_concurrent_requests slot workers take them from the
+        # pending queue, and exit when processing stops
+        self._active = 0
+        self._active_cond = threading.Condition()
+        self._pending = deque()
+        self._slot_workers = []
+        # Requests generating right now, and how many have ever started, to
+        # tell which ones overlapped
+        self._running = 0
+        self._run_starts = 0
+        self._calibration_lock = threading.Lock()
+        # (monotonic time, forecast) of the last power forecast
+        self._forecast_cache = (0.0, None)
         self.immediate_mode = immediate_mode
         self.power_calibration_data = self.load_power_calibration_data()
+        self._saved_calibration = dict(self.power_calibration_data)
         
     def load_power_calibration_data(self) -> Dict[str, float]:
         """Load power calibration data from file or create default."""
         try:
-            if os.path.exists("power_calibration_data.json"):
-                with open("power_calibration_data.json", "r") as f:
+            if os.path.exists(CALIBRATION_FILE):
+                with open(CALIBRATION_FILE, "r") as f:
                     return json.load(f)
         except Exception as e:
-            print(f"Error loading calibration data: {e}")
+            logger.error("Error loading calibration data: %s", e)
             
         # Default power estimates if no calibration data exists
         return {
@@ -60,10 +105,26 @@ class PowerAwareScheduler:
     def save_power_calibration_data(self) -> None:
         """Save power calibration data to file."""
         try:
-            with open("power_calibration_data.json", "w") as f:
-                json.dump(self.power_calibration_data, f)
+            # Write a temporary file and swap it in, so losing power mid-write
+            # can't leave a truncated file behind
+            payload = json.dumps(self.power_calibration_data, separators=(",", ":"))
+            tmp_file = f"{CALIBRATION_FILE}.tmp"
+            with open(tmp_file, "w") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, CALIBRATION_FILE)
+            self._saved_calibration = dict(self.power_calibration_data)
         except Exception as e:
-            print(f"Error saving calibration data: {e}")
+            logger.error("Error saving calibration data: %s", e)
+    
+    def _calibration_changed(self) -> bool:
+        """Whether calibration has drifted enough from the saved values to save it."""
+        for key, value in self.power_calibration_data.items():
+            saved = self._saved_calibration.get(key)
+            if saved is None or abs(value - saved) > CALIBRATION_SAVE_THRESHOLD * abs(saved):
+                return True
+        return False
     
     def estimate_tokens(self, prompt: str) -> int:
         """Estimate number of tokens in prompt.
@@ -132,25 +193,18 @@ class PowerAwareScheduler:
             estimated_completion = now + process_delay + queue_delay
         else:
             # Get power prediction for coming hours
-            power_prediction = self.power_monitor.predict_future_availability(24)
+            power_prediction = self._get_power_forecast()
             
             # Default to a far future time
             estimated_completion = now + timedelta(hours=24)
             
-            # Find earliest time when power will be sufficient
+            # Find earliest time when power will be sufficient; the forecast
+            # is in hour order, so the first suitable hour is the earliest
             for i, prediction in enumerate(power_prediction):
                 if prediction["processing_capable"] and power_needed <= prediction["solar_output"]:
-                    hour_delay = timedelta(hours=i)
-                    process_delay = timedelta(seconds=processing_time)
-                    candidate_time = now + hour_delay + process_delay + queue_delay
-                    
-                    # Take the earliest time
-                    if candidate_time < estimated_completion:
-                        estimated_completion = candidate_time
-                    
-                    # If we found a time within the next few hours, we can stop looking
-                    if i < 6:  # Within 6 hours
-                        break
+                    candidate_time = now + timedelta(hours=i, seconds=processing_time) + queue_delay
+                    estimated_completion = min(estimated_completion, candidate_time)
+                    break
         
         # Add to queue
         request_id = self.request_queue.enqueue(
@@ -160,127 +214,258 @@ class PowerAwareScheduler:
             estimated_completion
         )
         
-        # Start processing loop if not already running
-        if not self.processing:
-            self.start_processing()
+        # Start the processing loop, or wake it if it is waiting for work
+        self.start_processing()
             
         return request_id, estimated_completion
     
+    def _get_power_forecast(self) -> List[Dict[str, Any]]:
+        """Get the 24-hour power forecast, reusing a recent one."""
+        cached_at, forecast = self._forecast_cache
+        now = time.monotonic()
+        if forecast is None or now - cached_at > FORECAST_CACHE_TTL:
+            forecast = self.power_monitor.predict_future_availability(24)
+            self._forecast_cache = (now, forecast)
+        return forecast
+    
     def start_processing(self) -> None:
-        """Start the queue processing loop in a separate thread."""
-        if not self.processing:
+        """Start the queue processing loop on the worker thread."""
+        with self._worker_lock:
             self.processing = True
+            if self._worker is not None and self._worker.is_alive():
+                if not self.stop_processing:
+                    self._wake_event.set()
+                    return
+                # A stopped worker finishes its current request before exiting
+                self._worker.join()
+            
             self.stop_processing = False
-            threading.Thread(target=self.process_queue_loop).start()
+            self._stop_event.clear()
+            self._wake_event.clear()
+            self._worker = threading.Thread(
+                target=self._run_worker, name="power_scheduler", daemon=True
+            )
+            self._worker.start()
+    
+    def _run_worker(self) -> None:
+        """Run the processing loop whenever there is work, until stopped."""
+        while not self.stop_processing:
+            self.process_queue_loop()
+            if self.stop_processing:
+                break
+            # Requests queued after the loop's last check, while it still
+            # reported itself as processing, didn't wake the worker
+            if self.request_queue.has_queued_requests():
+                continue
+            self._wake_event.wait()
+            self._wake_event.clear()
     
     def stop(self) -> None:
         """Stop the queue processing loop."""
         self.stop_processing = True
+        self._stop_event.set()
+        self._wake_event.set()
+        with self._active_cond:
+            self._active_cond.notify_all()
     
     def process_queue_loop(self) -> None:
         """Main loop for processing queued requests."""
         self.processing = True
-        print(f"[DEBUG] Scheduler: Starting queue processing loop in {'immediate' if self.immediate_mode else 'normal'} mode")
+        logger.debug("Starting queue processing loop in %s mode", "immediate" if self.immediate_mode else "normal")
+        
+        power_status = None
+        status_checked_at = 0.0
+        requests_since_check = 0
         
         while not self.stop_processing:
-            # Check current power availability
-            power_status = self.power_monitor.get_current_status()
+            if self.llm_processor.max_concurrent_requests > 1:
+                self._wait_for_free_slot()
+                if self.stop_processing:
+                    break
+            
+            # Check current power availability, unless a recent check can be
+            # reused for the next request
+            if (power_status is None
+                    or requests_since_check >= POWER_RECHECK_REQUESTS
+                    or time.monotonic() - status_checked_at > POWER_RECHECK_INTERVAL):
+                power_status = self.power_monitor.get_current_status()
+                status_checked_at = time.monotonic()
+                requests_since_check = 0
+                logger.debug("Power status - battery: %.2f%%, solar: %.2fW",
+                             power_status['battery_level'], power_status["solar_output"])
             available_power = power_status["solar_output"]
-            print(f"[DEBUG] Scheduler: Power status - battery: {power_status['battery_level']:.2f}%, solar: {available_power:.2f}W")
             
             # In immediate mode, we process if battery > 30%, regardless of solar output
             # In normal mode, we need both battery > 30% and sufficient solar power
             if power_status["battery_level"] > 30:
                 # Get next request that can be processed with available power
-                print(f"[DEBUG] Scheduler: Looking for next processable request (immediate_mode={self.immediate_mode})")
+                logger.debug("Looking for next processable request (immediate_mode=%s)", self.immediate_mode)
                 next_request = self.request_queue.get_next_processable_request(available_power, self.immediate_mode)
                 
                 if next_request:
                     # Update status to processing
-                    print(f"[DEBUG] Scheduler: Processing request id={next_request['id']}, conversation_id={next_request['conversation_id']}")
-                    print(f"[DEBUG] Scheduler: Prompt: {next_request['prompt'][:50]}...")
+                    logger.debug("Processing request id=%s, conversation_id=%s", next_request['id'], next_request['conversation_id'])
+                    # %.50s truncates the prompt only if the message is emitted
+                    logger.debug("Prompt: %.50s...", next_request['prompt'])
                     self.request_queue.update_request_status(next_request["id"], "processing")
+                    requests_since_check += 1
                     
-                    # Process the request
-                    try:
-                        # Monitor power during processing
-                        initial_power = self.power_monitor.get_current_power_reading()
-                        initial_time = time.time()
-                        
-                        print("[DEBUG] Scheduler: Calling LLM processor to generate response")
-                        # Generate response
-                        response = self.llm_processor.generate_response(next_request["prompt"])
-                        
-                        # Record final power usage
-                        final_power = self.power_monitor.get_current_power_reading()
-                        final_time = time.time()
-                        
-                        print(f"[DEBUG] Scheduler: Response generation completed in {final_time - initial_time:.2f} seconds")
-                        
-                        # Update power calibration data
-                        self.update_power_calibration(
-                            initial_power, 
-                            final_power, 
-                            initial_time,
-                            final_time,
-                            next_request["prompt"], 
-                            response
-                        )
-                        
-                        # Update request status to completed
-                        print(f"[DEBUG] Scheduler: Updating request status to completed")
-                        self.request_queue.update_request_status(
-                            next_request["id"], 
-                            "completed", 
-                            response
-                        )
-                        
-                        # Call callback function if provided
-                        if self.callback_fn:
-                            try:
-                                # Check if we have a valid conversation_id
-                                conversation_id = next_request.get("conversation_id")
-                                if conversation_id and conversation_id != "None":
-                                    print(f"[DEBUG] Scheduler: Calling callback for conversation_id={conversation_id}")
-                                    self.callback_fn(conversation_id)
-                                else:
-                                    print(f"[DEBUG] Scheduler: No valid conversation_id found, response won't be displayed")
-                                    # Try updating the UI for recent requests
-                                    conn = sqlite3.connect(self.request_queue.db_path)
-                                    conn.row_factory = sqlite3.Row
-                                    cursor = conn.cursor()
-                                    cursor.execute('SELECT conversation_id FROM requests WHERE id = ?', (next_request["id"],))
-                                    row = cursor.fetchone()
-                                    if row and row['conversation_id'] and row['conversation_id'] != "None":
-                                        print(f"[DEBUG] Scheduler: Found updated conversation_id={row['conversation_id']}, updating page")
-                                        self.callback_fn(row['conversation_id'])
-                                    conn.close()
-                            except Exception as e:
-                                print(f"[DEBUG] Error in callback: {e}")
-                        
-                    except Exception as e:
-                        print(f"[DEBUG] Error processing request: {e}")
-                        import traceback
-                        print(f"[DEBUG] Traceback: {traceback.format_exc()}")
-                        self.request_queue.update_request_status(next_request["id"], "failed")
+                    if self.llm_processor.max_concurrent_requests > 1:
+                        self._start_in_slot(next_request)
+                    else:
+                        self._process_request(next_request)
+                elif self._queue_drained():
+                    logger.debug("Queue empty, stopping processing loop")
+                    break
                 else:
-                    # No processable requests, sleep
-                    print("[DEBUG] Scheduler: No processable requests found, sleeping")
-                    time.sleep(10)
+                    # No processable requests, sleep until one is queued
+                    logger.debug("No processable requests found, sleeping")
+                    power_status = None
+                    self._wake_event.wait(10)
+                    self._wake_event.clear()
+                    if self.stop_processing:
+                        break
             else:
                 # Battery too low, sleep
-                print(f"[DEBUG] Scheduler: Battery level too low ({power_status['battery_level']:.2f}%), sleeping")
-                time.sleep(30)
-            
-            # Check if queue is empty and no active processing
-            queue_length = self.request_queue.get_queue_length()
-            print(f"[DEBUG] Scheduler: Current queue length: {queue_length}")
-            if queue_length == 0:
-                print("[DEBUG] Scheduler: Queue empty, stopping processing loop")
-                break
+                logger.debug("Battery level too low (%.2f%%), sleeping", power_status['battery_level'])
+                power_status = None
+                if self._stop_event.wait(30):
+                    break
                 
         self.processing = False
-        print("[DEBUG] Scheduler: Processing loop stopped")
+        logger.debug("Processing loop stopped")
+    
+    def _queue_drained(self) -> bool:
+        """Whether nothing is left to process, once requests in progress finish.
+        
+        Only called when no processable request was found, so the queue is
+        checked once per idle iteration rather than after every request.
+        """
+        if self.request_queue.has_queued_requests():
+            return False
+        if self._active:
+            # Wait for the requests still in progress, as more may be
+            # queued meanwhile without starting another loop
+            with self._active_cond:
+                self._active_cond.wait_for(
+                    lambda: self._active == 0 or self.stop_processing
+                )
+            return not self.request_queue.has_queued_requests()
+        return True
+    
+    def _process_request(self, next_request: Dict[str, Any]) -> None:
+        """Generate the response for a request already marked as processing."""
+        with self._active_cond:
+            self._running += 1
+            self._run_starts += 1
+            run_start = self._run_starts
+            overlapped = self._running > 1
+        try:
+            # Monitor power during processing
+            initial_power = self.power_monitor.get_current_power_reading()
+            initial_time = time.time()
+            
+            logger.debug("Calling LLM processor to generate response")
+            # Generate response
+            response = self.llm_processor.generate_response(next_request["prompt"])
+            
+            # Record final power usage
+            final_power = self.power_monitor.get_current_power_reading()
+            final_time = time.time()
+            
+            logger.debug("Response generation completed in %.2f seconds", final_time - initial_time)
+            
+            # Update power calibration data, unless other requests shared the
+            # time and power this one measured
+            with self._active_cond:
+                overlapped = overlapped or self._run_starts != run_start
+            if overlapped:
+                logger.debug("Request overlapped others, skipping calibration")
+            else:
+                with self._calibration_lock:
+                    self.update_power_calibration(
+                        initial_power, 
+                        final_power, 
+                        initial_time,
+                        final_time,
+                        next_request["prompt"], 
+                        response
+                    )
+            
+            # Update request status to completed
+            logger.debug("Updating request status to completed")
+            self.request_queue.update_request_status(
+                next_request["id"], 
+                "completed", 
+                response
+            )
+            
+            # Call callback function if provided
+            if self.callback_fn:
+                try:
+                    # Check if we have a valid conversation_id
+                    conversation_id = next_request.get("conversation_id")
+                    if conversation_id and conversation_id != "None":
+                        logger.debug("Calling callback for conversation_id=%s", conversation_id)
+                        self.callback_fn(conversation_id)
+                    else:
+                        logger.debug("No valid conversation_id found, response won't be displayed")
+                        # Try updating the UI for recent requests
+                        row = self.request_queue.get_request(next_request["id"])
+                        if row and row['conversation_id'] and row['conversation_id'] != "None":
+                            logger.debug("Found updated conversation_id=%s, updating page", row['conversation_id'])
+                            self.callback_fn(row['conversation_id'])
+                except Exception as e:
+                    logger.error("Error in callback: %s", e)
+            
+        except Exception as e:
+            logger.exception("Error processing request: %s", e)
+            self.request_queue.update_request_status(next_request["id"], "failed")
+        finally:
+            with self._active_cond:
+                self._running -= 1
+        
+        self._completed_event.set()
+
+    def _start_in_slot(self, next_request: Dict[str, Any]) -> None:
+        """Hand a request to a slot worker, to process alongside other requests."""
+        with self._active_cond:
+            self._active += 1
+            self._pending.append(next_request)
+            if len(self._slot_workers) < self.llm_processor.max_concurrent_requests:
+                worker = threading.Thread(
+                    target=self._run_slot_worker, name="power_scheduler_slot", daemon=True
+                )
+                self._slot_workers.append(worker)
+                worker.start()
+            self._active_cond.notify_all()
+    
+    def _run_slot_worker(self) -> None:
+        """Process pending requests as they are handed over, until stopped."""
+        while True:
+            with self._active_cond:
+                self._active_cond.wait_for(
+                    lambda: self._pending or self.stop_processing
+                )
+                if not self._pending:
+                    self._slot_workers.remove(threading.current_thread())
+                    return
+                next_request = self._pending.popleft()
+            
+            try:
+                self._process_request(next_request)
+            finally:
+                with self._active_cond:
+                    self._active -= 1
+                    self._active_cond.notify_all()
+    
+    def _wait_for_free_slot(self) -> None:
+        """Wait until fewer requests are in progress than the processor can batch."""
+        limit = self.llm_processor.max_concurrent_requests
+        with self._active_cond:
+            self._active_cond.wait_for(
+                lambda: self._active < limit or self.stop_processing
+            )
     
     def update_power_calibration(self, 
                                 initial_power: Dict[str, Any], 
@@ -301,7 +486,7 @@ class PowerAwareScheduler:
         """
         # Calculate time elapsed
         time_elapsed = final_time - initial_time
-        if time_elapsed <= 0:
+        if time_elapsed < MIN_CALIBRATION_SECONDS:
             return
             
         # Calculate average power used
@@ -319,10 +504,15 @@ class PowerAwareScheduler:
         total_tokens = prompt_tokens + response_tokens
         
         # Update calibration data
-        if total_tokens > 0:
+        if total_tokens >= MIN_CALIBRATION_TOKENS:
             tokens_per_second = total_tokens / time_elapsed
             token_processing_power = (average_power - self.power_calibration_data["base_power"]) / total_tokens
             
+            # Power readings below the base load are noise, such as a passing
+            # cloud, not a request that used negative power
+            if token_processing_power < 0:
+                return
+            
             # Update with weighted average (90% old, 10% new)
             self.power_calibration_data["tokens_per_second"] = (
                 self.power_calibration_data["tokens_per_second"] * 0.9 + tokens_per_second * 0.1
@@ -331,8 +521,9 @@ class PowerAwareScheduler:
                 self.power_calibration_data["token_processing_power"] * 0.9 + token_processing_power * 0.1
             )
             
-            # Save updated calibration data
-            self.save_power_calibration_data()
+            # Save updated calibration data, if it moved noticeably
+            if self._calibration_changed():
+                self.save_power_calibration_data()
     
     def get_request_info(self, request_id: str) -> Dict[str, Any]:
         """Get information about a specific request.
@@ -9,6 +9,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from web import ConversationManager
 from queue import RequestQueue
+from power_monitor import MockPowerMonitor
 
 @pytest.fixture
 def test_dir():
@@ -26,24 +27,15 @@ def test_dir():
 def test_db():
     """Create a temporary test database"""
     db_path = "test_conversation_queue.db"
-    # Remove the test database if it exists
-    if os.path.exists(db_path):
-        os.remove(db_path)
+    # Remove the test database (and any WAL sidecar files) if it exists
+    for path in (db_path, f"{db_path}-wal", f"{db_path}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
     yield db_path
     # Clean up after the tests
-    if os.path.exists(db_path):
-        os.remove(db_path)
-
-class MockPowerMonitor:
-    def get_current_status(self):
-        """Mock power status for testing"""
-        return {
-            "battery_level": 75.0,
-            "solar_output": 15.5,
-            "power_consumption": 2.0,
-            "temperature": 25.0,
-            "timestamp": int(datetime.now().timestamp())
-        }
+    for path in (db_path, f"{db_path}-wal", f"{db_path}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
 
 def test_create_new_conversation(test_dir):
     """Test creating a new conversation without power monitor"""
@@ -158,6 +150,51 @@ def test_update_conversation_page(test_dir, test_db):
         # The second request should still be in the queue
         assert "Your request is queued" in content
 
+def test_power_status_shared_between_pages(test_dir):
+    """Test that pages rendered together read the power status once"""
+    class CountingPowerMonitor(MockPowerMonitor):
+        calls = 0
+        
+        def get_current_status(self):
+            CountingPowerMonitor.calls += 1
+            return super().get_current_status()
+    
+    manager = ConversationManager(static_pages_dir=test_dir, power_monitor=CountingPowerMonitor())
+    
+    for _ in range(3):
+        conversation_id = str(uuid.uuid4())
+        os.makedirs(f"{test_dir}/{conversation_id}", exist_ok=True)
+        manager.update_conversation_page(conversation_id)
+    
+    assert CountingPowerMonitor.calls == 1
+
+def test_user_text_escaped(test_dir, test_db):
+    """Test that prompts and responses are shown as text, not markup"""
+    request_queue = RequestQueue(db_path=test_db)
+    manager = ConversationManager(static_pages_dir=test_dir, request_queue=request_queue)
+    
+    prompt = "<script>alert(1)</script>"
+    conversation_id = manager.create_new_conversation(prompt)
+    request_id = request_queue.enqueue(conversation_id, prompt, 2.5, datetime.now())
+    request_queue.update_request_status(request_id, "completed", "Use <b> & <i> tags")
+    manager.update_conversation_page(conversation_id)
+    
+    with open(manager.get_conversation_path(conversation_id), 'r') as f:
+        content = f.read()
+    assert "<script>" not in content
+    assert "&lt;script&gt;alert(1)&lt;/script&gt;" in content
+    assert "Use &lt;b&gt; &amp; &lt;i&gt; tags" in content
+
+def test_page_replaced_atomically(test_dir):
+    """Test that rewriting a page leaves no temporary files behind"""
+    manager = ConversationManager(static_pages_dir=test_dir)
+    
+    conversation_id = manager.create_new_conversation("First prompt")
+    manager.update_conversation_page(conversation_id)
+    
+    assert os.listdir(f"{test_dir}/{conversation_id}") == ["index.html"]
+    assert os.stat(manager.get_conversation_path(conversation_id)).st_mode & 0o777 == 0o644
+
 def test_conversation_exists(test_dir):
     """Test checking if a conversation exists"""
     manager = ConversationManager(static_pages_dir=test_dir)
@@ -174,4 +211,4 @@ def test_conversation_exists(test_dir):
     assert manager.conversation_exists(conversation_id)
     
     # Check that a non-existent conversation doesn't exist
-    assert not manager.conversation_exists("non-existent-id")
\ No newline at end of file
+    assert not manager.conversation_exists("non-existent-id")
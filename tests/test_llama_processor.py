@@ -3,7 +3,9 @@ import pytest
 import unittest
 from unittest.mock import patch, MagicMock, mock_open
 import subprocess
-from llm_processor import LlamaProcessor
+from llm_processor import LlamaProcessor, LlamaServerTimeout
+from llm_processor.llama_processor import battery_check_interval
+from llm_processor.power_tracker import ProcessingPowerTracker
 from power_monitor import MockPowerMonitor
 
 
@@ -25,9 +27,10 @@ class TestLlamaProcessor(unittest.TestCase):
         self.popen_patch = patch('subprocess.Popen')
         self.popen_mock = self.popen_patch.start()
         
-        # Setup mock process
+        # Setup mock process, with real pipes for its output
         self.mock_process = MagicMock()
-        self.mock_process.stdout = ["Mock response line 1\n", "Mock response line 2\n"]
+        self.mock_process.stdout = self._pipe_with(b"Mock response line 1\nMock response line 2\n")
+        self.mock_process.stderr = self._pipe_with(b"")
         self.mock_process.poll.return_value = None  # Process is running
         self.mock_process.wait.return_value = 0     # Exit code 0
         self.popen_mock.return_value = self.mock_process
@@ -36,6 +39,16 @@ class TestLlamaProcessor(unittest.TestCase):
         # Stop all patches
         self.path_exists_patch.stop()
         self.popen_patch.stop()
+        self.mock_process.stdout.close()
+        self.mock_process.stderr.close()
+
+    @staticmethod
+    def _pipe_with(data):
+        """Return the read end of a pipe that yields `data` and then EOF."""
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, data)
+        os.close(write_fd)
+        return os.fdopen(read_fd)
     
     def test_init(self):
         """Test initialization of LlamaProcessor."""
@@ -78,7 +91,7 @@ class TestLlamaProcessor(unittest.TestCase):
         # Verify subprocess was called with correct arguments
         self.popen_mock.assert_called_once()
         args, kwargs = self.popen_mock.call_args
-        self.assertEqual(kwargs['text'], True)
+        self.assertNotIn('text', kwargs)
         self.assertEqual(args[0][0], "/path/to/llama.cpp")
         self.assertEqual(args[0][1], "-m")
         self.assertEqual(args[0][2], "/path/to/model.gguf")
@@ -87,7 +100,148 @@ class TestLlamaProcessor(unittest.TestCase):
         
         # Verify power monitor was used
         self.assertEqual(self.mock_power_monitor.is_processing, False)
-    
+
+    @patch('os.access', return_value=True)
+    def test_read_process_output_stops_on_low_battery(self, access_mock):
+        """Test that llama.cpp is terminated when the battery runs low."""
+        processor = LlamaProcessor(
+            model_path="/path/to/model.gguf",
+            power_monitor=self.mock_power_monitor,
+            llama_cpp_path="/path/to/llama.cpp"
+        )
+        self.mock_power_monitor.battery_level = 10
+
+        output, _ = processor._read_process_output(self.mock_process, check_interval=0)
+
+        self.assertIn("Mock response line 1", output)
+        self.mock_process.terminate.assert_called_once()
+
+    @patch('os.access', return_value=True)
+    def test_read_process_output_without_stderr(self, access_mock):
+        """Test reading llama.cpp output when stderr isn't piped."""
+        processor = LlamaProcessor(
+            model_path="/path/to/model.gguf",
+            power_monitor=self.mock_power_monitor,
+            llama_cpp_path="/path/to/llama.cpp"
+        )
+        stderr, self.mock_process.stderr = self.mock_process.stderr, None
+        try:
+            output, stderr_output = processor._read_process_output(self.mock_process)
+        finally:
+            self.mock_process.stderr = stderr
+
+        self.assertEqual(output, "Mock response line 1\nMock response line 2\n")
+        self.assertEqual(stderr_output, "")
+
+    @patch('os.access', return_value=True)
+    def test_generate_response_mmap_option(self, access_mock):
+        """Test that memory mapping is only disabled for predictable power."""
+        processor = LlamaProcessor(
+            model_path="/path/to/model.gguf",
+            power_monitor=self.mock_power_monitor,
+            llama_cpp_path="/path/to/llama.cpp"
+        )
+        processor.generate_response("Test prompt")
+        cmd = self.popen_mock.call_args[0][0]
+        self.assertNotIn("--no-mmap", cmd)
+        self.assertEqual(cmd[cmd.index("-t") + 1], str(processor.n_threads))
+        self.assertEqual(cmd[cmd.index("-tb") + 1], str(processor.n_threads_batch))
+
+        processor = LlamaProcessor(
+            model_path="/path/to/model.gguf",
+            power_monitor=self.mock_power_monitor,
+            llama_cpp_path="/path/to/llama.cpp",
+            predictable_power=True,
+            n_threads=2
+        )
+        processor.generate_response("Test prompt")
+        cmd = self.popen_mock.call_args[0][0]
+        self.assertIn("--no-mmap", cmd)
+        self.assertEqual(cmd[cmd.index("-t") + 1], "2")
+
+    def test_generate_response_in_process(self):
+        """Test generating a response with the llama-cpp-python bindings."""
+        mock_llm = MagicMock(return_value={"choices": [{"text": " In-process response<end>"}]})
+
+        with patch('llm_processor.llama_processor.Llama', return_value=mock_llm) as llama_mock, \
+                patch('llm_processor.llama_processor.StoppingCriteriaList', create=True):
+            processor = LlamaProcessor(
+                model_path="/path/to/model.gguf",
+                power_monitor=self.mock_power_monitor,
+                llama_cpp_path="/path/to/llama.cpp",
+                use_bindings=True
+            )
+            response = processor.generate_response("Test prompt", max_tokens=64)
+
+        # The model is loaded once and no subprocess is started
+        llama_mock.assert_called_once()
+        self.popen_mock.assert_not_called()
+        self.assertEqual(mock_llm.call_args[1]['max_tokens'], 64)
+        self.assertEqual(response, "In-process response")
+
+    def test_bindings_missing(self):
+        """Test that asking for bindings without llama-cpp-python fails."""
+        with patch('llm_processor.llama_processor.Llama', None):
+            with self.assertRaises(ImportError):
+                LlamaProcessor(
+                    model_path="/path/to/model.gguf",
+                    power_monitor=self.mock_power_monitor,
+                    llama_cpp_path="/path/to/llama.cpp",
+                    use_bindings=True
+                )
+        self.popen_mock.assert_not_called()
+
+    def test_generate_response_with_server(self):
+        """Test generating a response with a persistent llama.cpp server."""
+        with patch('llm_processor.llama_processor.LlamaServer') as server_mock:
+            server_mock.return_value.complete.return_value = " Server response<end>"
+            processor = LlamaProcessor(
+                model_path="/path/to/model.gguf",
+                power_monitor=self.mock_power_monitor,
+                server_path="/path/to/llama-server"
+            )
+            response = processor.generate_response("Test prompt", max_tokens=64)
+
+        # The server is started once, and no llama.cpp process per request
+        server_mock.return_value.start.assert_called_once()
+        self.popen_mock.assert_not_called()
+        self.assertEqual(server_mock.return_value.complete.call_args[0][:2], ("Test prompt", 64))
+        self.assertEqual(response, "Server response")
+
+    def test_generate_response_server_timeout(self):
+        """Test that a stalled llama.cpp server fails the request."""
+        with patch('llm_processor.llama_processor.LlamaServer') as server_mock:
+            server_mock.return_value.complete.side_effect = LlamaServerTimeout("stalled")
+            processor = LlamaProcessor(
+                model_path="/path/to/model.gguf",
+                power_monitor=self.mock_power_monitor,
+                server_path="/path/to/llama-server"
+            )
+            with self.assertRaises(LlamaServerTimeout):
+                processor.generate_response("Test prompt", max_tokens=64)
+
+        self.assertEqual(self.mock_power_monitor.is_processing, False)
+
+    def test_power_tracker_overlapping_requests(self):
+        """Test that overlapping requests share the processing state and drain."""
+        monitor = MagicMock()
+        tracker = ProcessingPowerTracker(monitor)
+        
+        with patch('llm_processor.power_tracker.time.monotonic', side_effect=[0.0, 1.0, 5.0, 6.0]):
+            first = tracker.start()
+            second = tracker.start()
+            tracker.charge(first)
+            tracker.finish()
+            # Still processing the second request
+            monitor.set_processing_state.assert_called_once_with(True)
+            tracker.charge(second)
+            tracker.finish()
+        
+        monitor.set_processing_state.assert_called_with(False)
+        # Six seconds of wall-clock time are charged once, not per request
+        charged = [c[0][0] for c in monitor.simulate_battery_change.call_args_list]
+        self.assertEqual(charged, [5.0, 1.0])
+
     def test_determine_max_tokens(self):
         """Test max token determination based on battery level."""
         processor = LlamaProcessor(
@@ -108,6 +262,25 @@ class TestLlamaProcessor(unittest.TestCase):
         
         self.mock_power_monitor.battery_level = 25
         self.assertEqual(processor.determine_max_tokens(), 256)
+
+        # Levels on a threshold get the lower limit
+        self.mock_power_monitor.battery_level = 80
+        self.assertEqual(processor.determine_max_tokens(), 1024)
+        
+        self.mock_power_monitor.battery_level = 30
+        self.assertEqual(processor.determine_max_tokens(), 256)
+
+        # A battery level that is already known is used without a new reading
+        with patch.object(self.mock_power_monitor, 'estimate_battery_level') as estimate_mock:
+            self.assertEqual(processor.determine_max_tokens(90), 2048)
+            estimate_mock.assert_not_called()
+    
+    def test_battery_check_interval(self):
+        """Test that battery checks back off while the battery is healthy."""
+        self.assertEqual(battery_check_interval(20, 1.0), 1.0)
+        self.assertEqual(battery_check_interval(40, 1.0), 10.0)
+        self.assertEqual(battery_check_interval(90, 1.0), 30.0)
+        self.assertEqual(battery_check_interval(22, 5.0), 5.0)
     
     def test_clean_response(self):
         """Test cleaning llama.cpp output."""
@@ -122,6 +295,11 @@ class TestLlamaProcessor(unittest.TestCase):
         clean = processor._clean_response(output, "Test prompt")
         self.assertEqual(clean, "This is the response")
         
+        # Test with the prompt echoed after a space
+        output = " Test prompt\nThis is the response"
+        clean = processor._clean_response(output, "Test prompt")
+        self.assertEqual(clean, "This is the response")
+        
         # Test with special tokens
         output = "Test prompt\nThis is the response<end>"
         clean = processor._clean_response(output, "Test prompt")
@@ -0,0 +1,57 @@
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from llm_processor import LlamaServer, LlamaServerTimeout
+
+
+@pytest.fixture
+def stalled_server():
+    """An HTTP server that accepts a completion request and then goes quiet."""
+    release = threading.Event()
+
+    class StalledHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            self.wfile.write(b'data: {"content": "Hello"}\n')
+            self.wfile.flush()
+            release.wait(5)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StalledHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd.server_address[1]
+    release.set()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_stalled_server_times_out(stalled_server, monkeypatch):
+    """Test that a request fails when the server stops sending output."""
+    server = LlamaServer("llama-server", [], port=stalled_server, read_timeout=0.2)
+    monkeypatch.setattr(server, "start", lambda: None)
+
+    pieces = []
+    started = time.monotonic()
+    with pytest.raises(LlamaServerTimeout):
+        for piece in server.stream("Test prompt", 16, 0.7):
+            pieces.append(piece)
+
+    assert pieces == ["Hello"]
+    assert time.monotonic() - started < 2
+
+
+def test_startup_failure_includes_server_output():
+    """Test that a server that exits at start-up reports what it printed."""
+    script = "import sys; print('error: failed to load model', file=sys.stderr); sys.exit(1)"
+    server = LlamaServer(sys.executable, ["-c", script], startup_timeout=10)
+
+    with pytest.raises(RuntimeError, match="failed to load model"):
+        server.start()
@@ -0,0 +1,22 @@
+import os
+import pytest
+import sys
+
+# Add the parent directory to the path so we can import our modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_processor import MockLLMProcessor
+
+@pytest.fixture
+def processor():
+    """Mock processor fast enough that canned responses return at once"""
+    return MockLLMProcessor(processing_speed=10000)
+
+def test_canned_response_case_insensitive(processor):
+    """Test that keywords match regardless of case"""
+    assert processor.generate_response("HELP me") == processor.canned_responses["help"]
+
+def test_canned_response_dict_order(processor):
+    """Test that the first keyword in dict order wins, not the first in the prompt"""
+    assert processor.generate_response("what time is it, hello") == processor.canned_responses["hello"]
+    assert processor.generate_response("weather or time?") == processor.canned_responses["time"]
@@ -1,5 +1,8 @@
+import json
 import os
+import shutil
 import sys
+import threading
 import pytest
 import time
 import uuid
@@ -14,17 +17,33 @@ from llm_processor import MockLLMProcessor
 from scheduler import PowerAwareScheduler
 
 
+CALIBRATION_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "power_calibration_data.json"
+)
+
+@pytest.fixture(autouse=True)
+def isolated_cwd(tmp_path, monkeypatch):
+    """Run each test in its own directory, seeded with the repository's
+    calibration data, so calibration saved by one test doesn't leak into the
+    next (or into the repository)."""
+    if os.path.exists(CALIBRATION_FILE):
+        shutil.copy(CALIBRATION_FILE, tmp_path)
+    monkeypatch.chdir(tmp_path)
+
 @pytest.fixture
 def test_db():
     """Create a temporary test database for the request queue."""
     db_path = "test_scheduler_queue.db"
-    # Remove the test database if it exists
-    if os.path.exists(db_path):
-        os.remove(db_path)
+    # Remove the test database (and any WAL sidecar files) if it exists
+    for path in (db_path, f"{db_path}-wal", f"{db_path}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
     yield db_path
     # Clean up after the tests
-    if os.path.exists(db_path):
-        os.remove(db_path)
+    for path in (db_path, f"{db_path}-wal", f"{db_path}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
 
 @pytest.fixture
 def power_monitor():
@@ -61,6 +80,27 @@ def scheduler(power_monitor, request_queue, llm_processor):
     time.sleep(0.1)  # Give it time to stop
 
 
+def wait_for_requests(scheduler, request_queue, request_ids, timeout=2.0):
+    """Wait until the requests are no longer queued or processing."""
+    deadline = time.monotonic() + timeout
+    while any(
+        request_queue.get_request(request_id)["status"] in ("queued", "processing")
+        for request_id in request_ids
+    ):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        scheduler._completed_event.wait(remaining)
+        scheduler._completed_event.clear()
+
+
+def wait_until_idle(scheduler, timeout=2.0):
+    """Wait until the processing loop has found the queue empty."""
+    deadline = time.monotonic() + timeout
+    while scheduler.processing and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
 def test_scheduler_initialization(scheduler):
     """Test that the scheduler initializes correctly."""
     assert scheduler.power_monitor is not None
@@ -134,6 +174,22 @@ def test_enqueue_prompt(scheduler, request_queue):
     assert estimated_time > datetime.now()
 
 
+def test_power_forecast_reused(scheduler, power_monitor, monkeypatch):
+    """Test that enqueues in quick succession share one power forecast."""
+    calls = []
+    predict = power_monitor.predict_future_availability
+    monkeypatch.setattr(
+        power_monitor, "predict_future_availability",
+        lambda hours_ahead=24: calls.append(hours_ahead) or predict(hours_ahead)
+    )
+    power_monitor.battery_level = 20.0
+    
+    for _ in range(3):
+        scheduler.enqueue_prompt(str(uuid.uuid4()), "Test prompt")
+    
+    assert calls == [24]
+
+
 def test_process_queue(scheduler, request_queue, power_monitor):
     """Test processing a queued request."""
     # Set battery level high enough for processing
@@ -146,8 +202,8 @@ def test_process_queue(scheduler, request_queue, power_monitor):
     prompt = "hello"
     request_id, _ = scheduler.enqueue_prompt(conversation_id, prompt)
     
-    # Let the scheduler process for a bit
-    time.sleep(2)
+    # Wait for the scheduler to process it
+    wait_for_requests(scheduler, request_queue, [request_id])
     
     # Check that the request was processed
     request = request_queue.get_request(request_id)
@@ -156,6 +212,49 @@ def test_process_queue(scheduler, request_queue, power_monitor):
     assert "Hello" in request["response"]  # Should match canned response
 
 
+def test_worker_thread_reused(scheduler, request_queue, power_monitor):
+    """Test that the processing loop is restarted on the same worker thread."""
+    power_monitor.battery_level = 80.0
+    scheduler.immediate_mode = True
+    
+    first_id, _ = scheduler.enqueue_prompt(str(uuid.uuid4()), "hello")
+    wait_for_requests(scheduler, request_queue, [first_id])
+    # Let the loop notice the queue is empty and go idle
+    wait_until_idle(scheduler)
+    assert request_queue.get_request(first_id)["status"] == "completed"
+    assert scheduler.processing is False
+    worker = scheduler._worker
+    
+    second_id, _ = scheduler.enqueue_prompt(str(uuid.uuid4()), "hello")
+    wait_for_requests(scheduler, request_queue, [second_id])
+    assert request_queue.get_request(second_id)["status"] == "completed"
+    assert scheduler._worker is worker
+
+
+def test_power_status_reused_while_draining(scheduler, request_queue, power_monitor, monkeypatch):
+    """Test that a burst of requests is processed on one power check."""
+    power_monitor.battery_level = 80.0
+    scheduler.immediate_mode = True
+    
+    calls = []
+    get_status = power_monitor.get_current_status
+    monkeypatch.setattr(
+        power_monitor, "get_current_status",
+        lambda: calls.append(1) or get_status()
+    )
+    
+    request_ids = request_queue.enqueue_many([
+        (str(uuid.uuid4()), "hello", 1.0, datetime.now())
+        for _ in range(3)
+    ])
+    scheduler.start_processing()
+    wait_for_requests(scheduler, request_queue, request_ids)
+    
+    for request_id in request_ids:
+        assert request_queue.get_request(request_id)["status"] == "completed"
+    assert len(calls) == 1
+
+
 def test_low_battery_no_processing(scheduler, request_queue, power_monitor):
     """Test that requests aren't processed when battery is low."""
     # Set battery level too low for processing
@@ -168,8 +267,8 @@ def test_low_battery_no_processing(scheduler, request_queue, power_monitor):
     prompt = "This should not be processed due to low battery."
     request_id, _ = scheduler.enqueue_prompt(conversation_id, prompt)
     
-    # Let the scheduler try to process for a bit
-    time.sleep(2)
+    # Give the scheduler a chance to (wrongly) process it
+    assert not scheduler._completed_event.wait(0.5)
     
     # Check that the request is still queued
     request = request_queue.get_request(request_id)
@@ -221,6 +320,140 @@ def test_update_power_calibration(scheduler):
     assert scheduler.power_calibration_data["token_processing_power"] != initial_token_power
 
 
+def test_update_power_calibration_ignores_noisy_samples(scheduler):
+    """Test that too short or implausible samples don't change calibration."""
+    calibration = dict(scheduler.power_calibration_data)
+    initial_time = time.time()
+    response = "Test response that is a bit longer to have more tokens"
+    
+    # Too short to measure
+    scheduler.update_power_calibration(
+        {"power": 10.0}, {"power": 12.0}, initial_time, initial_time + 0.1, "Test prompt", response
+    )
+    # Too few tokens
+    scheduler.update_power_calibration(
+        {"power": 10.0}, {"power": 12.0}, initial_time, initial_time + 10, "Hi", "Hi"
+    )
+    # Less power than the base load
+    scheduler.update_power_calibration(
+        {"power": 0.5}, {"power": 0.5}, initial_time, initial_time + 10, "Test prompt", response
+    )
+    
+    assert scheduler.power_calibration_data == calibration
+
+
+def test_calibration_saved_only_when_changed(scheduler):
+    """Test that calibration is only written once it has moved noticeably."""
+    assert not scheduler._calibration_changed()
+    
+    # A small drift isn't worth a write
+    scheduler.power_calibration_data["tokens_per_second"] *= 1.01
+    assert not scheduler._calibration_changed()
+    
+    scheduler.power_calibration_data["tokens_per_second"] *= 1.1
+    assert scheduler._calibration_changed()
+    
+    scheduler.save_power_calibration_data()
+    with open("power_calibration_data.json") as f:
+        assert json.load(f) == scheduler.power_calibration_data
+    assert not os.path.exists("power_calibration_data.json.tmp")
+    assert not scheduler._calibration_changed()
+
+
+def test_stop_interrupts_idle_wait(scheduler, power_monitor, monkeypatch):
+    """Test that stopping the scheduler doesn't wait out its idle sleep."""
+    checked = threading.Event()
+    get_status = power_monitor.get_current_status
+    monkeypatch.setattr(
+        power_monitor, "get_current_status",
+        lambda: checked.set() or get_status()
+    )
+    # Set battery level too low so the loop goes into its long wait
+    power_monitor.battery_level = 20.0
+    scheduler.enqueue_prompt(str(uuid.uuid4()), "This waits for more power.")
+    assert checked.wait(5)
+    assert scheduler.processing is True
+    
+    # The low battery wait is 30 seconds
+    scheduler.stop()
+    scheduler._worker.join(5)
+    assert not scheduler._worker.is_alive()
+    assert scheduler.processing is False
+
+
+def test_enqueue_wakes_idle_loop(scheduler, request_queue, power_monitor, monkeypatch):
+    """Test that a new request doesn't wait out the loop's idle sleep."""
+    looked = threading.Event()
+    get_next = request_queue.get_next_processable_request
+    monkeypatch.setattr(
+        request_queue, "get_next_processable_request",
+        lambda *args: looked.set() or get_next(*args)
+    )
+    power_monitor.battery_level = 80.0
+    
+    # A request that needs more power than is available keeps the loop idle
+    request_queue.enqueue(str(uuid.uuid4()), "Too big", 1000.0, datetime.now())
+    scheduler.start_processing()
+    assert looked.wait(5)
+    
+    # The idle wait is 10 seconds
+    request_id = request_queue.enqueue(str(uuid.uuid4()), "hello", 0.1, datetime.now())
+    scheduler.start_processing()
+    wait_for_requests(scheduler, request_queue, [request_id], timeout=5.0)
+    assert request_queue.get_request(request_id)["status"] == "completed"
+
+
+def test_process_queue_concurrently(power_monitor, request_queue):
+    """Test that requests are processed together when the processor can batch them."""
+    running = [0]
+    max_running = [0]
+    running_lock = threading.Lock()
+    
+    class BatchingProcessor(MockLLMProcessor):
+        __slots__ = ()
+        max_concurrent_requests = 2
+        
+        def generate_response(self, prompt, max_tokens=None):
+            with running_lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            try:
+                return super().generate_response(prompt, max_tokens)
+            finally:
+                with running_lock:
+                    running[0] -= 1
+    
+    power_monitor.battery_level = 80.0
+    scheduler = PowerAwareScheduler(
+        power_monitor=power_monitor,
+        request_queue=request_queue,
+        llm_processor=BatchingProcessor(power_monitor=power_monitor, processing_speed=20),
+        immediate_mode=True
+    )
+    calibration = dict(scheduler.power_calibration_data)
+    
+    request_ids = [
+        scheduler.enqueue_prompt(str(uuid.uuid4()), "hello")[0]
+        for _ in range(4)
+    ]
+    
+    try:
+        wait_for_requests(scheduler, request_queue, request_ids, timeout=10.0)
+        for request_id in request_ids:
+            assert request_queue.get_request(request_id)["status"] == "completed"
+    finally:
+        scheduler.stop()
+    
+    # Never more requests at once than the processor can batch, from a
+    # fixed set of slot workers
+    assert max_running[0] == 2
+    assert len(scheduler._slot_workers) <= 2
+    # Overlapping requests don't calibrate, and the monitor only leaves the
+    # processing state once all of them are done
+    assert scheduler.power_calibration_data == calibration
+    assert power_monitor.is_processing is False
+
+
 def test_callback_function(scheduler, request_queue, power_monitor):
     """Test that the callback function is called when a request completes."""
     # Set battery level high enough for processing
@@ -242,10 +475,10 @@ def test_callback_function(scheduler, request_queue, power_monitor):
     
     # Enqueue a simple prompt that has a canned response
     prompt = "hello"
-    scheduler.enqueue_prompt(conversation_id, prompt)
+    request_id, _ = scheduler.enqueue_prompt(conversation_id, prompt)
     
-    # Let the scheduler process for a bit
-    time.sleep(2)
+    # Wait for the scheduler to process it
+    wait_for_requests(scheduler, scheduler.request_queue, [request_id])
     
     # Check that the callback was called with the correct conversation ID
     assert callback_called[0] is True
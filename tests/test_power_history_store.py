@@ -0,0 +1,43 @@
+import json
+import os
+import pytest
+import sys
+
+# Add the parent directory to the path so we can import our modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from power_monitor.history_store import PowerHistoryStore
+
+@pytest.fixture
+def test_db(tmp_path):
+    """Path for a temporary history database"""
+    return str(tmp_path / "power_history.db")
+
+def test_set_solar_pattern(test_db):
+    """Test that solar patterns are stored and replaced per hour"""
+    store = PowerHistoryStore(db_path=test_db)
+    
+    store.set_solar_pattern(12, 10.0)
+    store.set_solar_pattern(12, 12.5)
+    store.set_solar_pattern(13, 8.0)
+    
+    # A new store sees the persisted values
+    assert PowerHistoryStore(db_path=test_db).load_solar_patterns() == {"12": 12.5, "13": 8.0}
+
+def test_import_json_history(test_db, tmp_path):
+    """Test the one-time import of a JSON power history file"""
+    history_file = tmp_path / "power_history.json"
+    history_file.write_text(json.dumps({
+        "daily_solar_patterns": {"6": 1.5, "12": 20.0},
+        "battery_discharge_rate": 0.5,
+        "last_updated": 0
+    }))
+    store = PowerHistoryStore(db_path=test_db)
+    
+    assert store.import_json_history(str(history_file))
+    assert store.load_solar_patterns() == {"6": 1.5, "12": 20.0}
+    
+    # Once the store has data, the file isn't imported again
+    store.set_solar_pattern(12, 5.0)
+    assert not store.import_json_history(str(history_file))
+    assert store.load_solar_patterns()["12"] == 5.0
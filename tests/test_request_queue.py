@@ -14,13 +14,15 @@ from queue import RequestQueue
 def test_db():
     """Create a temporary test database"""
     db_path = "test_queue.db"
-    # Remove the test database if it exists
-    if os.path.exists(db_path):
-        os.remove(db_path)
+    # Remove the test database (and any WAL sidecar files) if it exists
+    for path in (db_path, f"{db_path}-wal", f"{db_path}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
     yield db_path
     # Clean up after the tests
-    if os.path.exists(db_path):
-        os.remove(db_path)
+    for path in (db_path, f"{db_path}-wal", f"{db_path}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
 
 def test_init_db(test_db):
     """Test that the database is initialized correctly"""
@@ -36,6 +38,19 @@ def test_init_db(test_db):
     assert len(tables) == 1
     assert tables[0][0] == 'requests'
 
+def test_queue_lookups_use_indexes(test_db):
+    """Test that the queue's frequent lookups don't scan the table"""
+    queue = RequestQueue(db_path=test_db)
+    conn = queue._get_connection()
+    
+    for sql, params in (
+        ("SELECT * FROM requests WHERE status = 'queued' ORDER BY submitted_at ASC LIMIT 1", ()),
+        ("SELECT * FROM requests WHERE conversation_id = ? ORDER BY submitted_at ASC", ("id",)),
+    ):
+        plan = " ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+        assert "USING INDEX" in plan
+        assert "TEMP B-TREE" not in plan
+
 def test_enqueue(test_db):
     """Test enqueueing a request"""
     queue = RequestQueue(db_path=test_db)
@@ -61,6 +76,23 @@ def test_enqueue(test_db):
     assert float(row['estimated_power']) == estimated_power
     assert row['status'] == 'queued'
 
+def test_enqueue_many(test_db):
+    """Test enqueueing several requests at once"""
+    queue = RequestQueue(db_path=test_db)
+    
+    conversation_id = str(uuid.uuid4())
+    estimated_completion = datetime.now() + timedelta(minutes=30)
+    
+    request_ids = queue.enqueue_many([
+        (conversation_id, "Test prompt 1", 2.5, estimated_completion),
+        (conversation_id, "Test prompt 2", 3.0, estimated_completion),
+    ])
+    
+    assert len(request_ids) == 2
+    assert queue.get_queue_length() == 2
+    assert queue.get_request(request_ids[0])['prompt'] == "Test prompt 1"
+    assert float(queue.get_request(request_ids[1])['estimated_power']) == 3.0
+
 def test_get_queue_length(test_db):
     """Test getting the queue length"""
     queue = RequestQueue(db_path=test_db)
@@ -85,6 +117,18 @@ def test_get_queue_length(test_db):
     # Now there should be two requests
     assert queue.get_queue_length() == 2
 
+def test_has_queued_requests(test_db):
+    """Test checking whether any request is queued"""
+    queue = RequestQueue(db_path=test_db)
+    
+    assert not queue.has_queued_requests()
+    
+    request_id = queue.enqueue(str(uuid.uuid4()), "Test prompt", 2.5, datetime.now() + timedelta(minutes=30))
+    assert queue.has_queued_requests()
+    
+    queue.update_request_status(request_id, "processing")
+    assert not queue.has_queued_requests()
+
 def test_get_request(test_db):
     """Test getting a request by ID"""
     queue = RequestQueue(db_path=test_db)
@@ -132,6 +176,47 @@ def test_update_request_status(test_db):
     assert request['status'] == 'completed'
     assert request['response'] == response
 
+def test_get_queue_position(test_db):
+    """Test getting the position of a request in the queue"""
+    queue = RequestQueue(db_path=test_db)
+    
+    conversation_id = str(uuid.uuid4())
+    estimated_completion = datetime.now() + timedelta(minutes=30)
+    
+    first = queue.enqueue(conversation_id, "Test prompt 1", 2.5, estimated_completion)
+    second, third = queue.enqueue_many([
+        (conversation_id, "Test prompt 2", 2.5, estimated_completion),
+        (conversation_id, "Test prompt 3", 2.5, estimated_completion),
+    ])
+    
+    assert queue.get_queue_position(first) == 1
+    assert queue.get_queue_position(second) == 2
+    assert queue.get_queue_position(third) == 3
+    
+    # Requests that are no longer queued have no position
+    queue.update_request_status(first, "processing")
+    assert queue.get_queue_position(first) is None
+    assert queue.get_queue_position(third) == 2
+    assert queue.get_queue_position("missing") is None
+
+def test_cached_reads_see_writes(test_db):
+    """Test that cached reads are invalidated by writes through the queue"""
+    queue = RequestQueue(db_path=test_db)
+    
+    estimated_completion = datetime.now() + timedelta(minutes=30)
+    request_id = queue.enqueue(str(uuid.uuid4()), "Test prompt", 2.5, estimated_completion)
+    
+    assert queue.get_queue_length() == 1
+    request = queue.get_request(request_id)
+    
+    # Changing a returned request doesn't change the cached one
+    request["queue_position"] = 1
+    assert "queue_position" not in queue.get_request(request_id)
+    
+    queue.update_request_status(request_id, "completed", "Test response")
+    assert queue.get_queue_length() == 0
+    assert queue.get_request(request_id)['status'] == 'completed'
+
 def test_get_next_processable_request(test_db):
     """Test getting the next processable request"""
     queue = RequestQueue(db_path=test_db)
@@ -174,4 +259,44 @@ def test_get_conversation_requests(test_db):
     
     assert len(requests) == 2
     assert requests[0]['prompt'] == prompt1
-    assert requests[1]['prompt'] == prompt2
\ No newline at end of file
+    assert requests[1]['prompt'] == prompt2
+
+
+def test_connection_reused(test_db):
+    """Test that the queue reuses one WAL-mode connection per thread"""
+    queue = RequestQueue(db_path=test_db)
+    
+    conn = queue._get_connection()
+    assert queue._get_connection() is conn
+    
+    journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    assert journal_mode == 'wal'
+
+def test_writer_rolls_back_on_error(test_db):
+    """Test that a failed write doesn't leave a transaction open"""
+    queue = RequestQueue(db_path=test_db)
+    
+    with pytest.raises(sqlite3.IntegrityError):
+        with queue.writer() as conn:
+            conn.execute("INSERT INTO requests (id) VALUES ('dup')")
+            conn.execute("INSERT INTO requests (id) VALUES ('dup')")
+    
+    assert not queue._get_connection().in_transaction
+    assert queue.get_request('dup') is None
+
+def test_iter_conversation_requests(test_db):
+    """Test streaming the requests of a conversation"""
+    queue = RequestQueue(db_path=test_db)
+    
+    conversation_id = str(uuid.uuid4())
+    estimated_completion = datetime.now() + timedelta(minutes=30)
+    
+    queue.enqueue(conversation_id, "Test prompt 1", 2.5, estimated_completion)
+    queue.enqueue(conversation_id, "Test prompt 2", 2.5, estimated_completion)
+    queue.enqueue(str(uuid.uuid4()), "Other conversation", 2.5, estimated_completion)
+    
+    prompts = [request['prompt'] for request in queue.iter_conversation_requests(conversation_id)]
+    assert prompts == ["Test prompt 1", "Test prompt 2"]
+    
+    # An invalid conversation ID yields nothing
+    assert list(queue.iter_conversation_requests(None)) == []
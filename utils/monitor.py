@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
+import struct
 import time
 import serial
 from Crypto.Cipher import AES
 
+# The measurements are little-endian 32-bit integers; bytes 48-103 of a
+# decrypted response hold all of them, so they are unpacked in one call
+MEASUREMENTS = struct.Struct("<14I")
+MEASUREMENTS_OFFSET = 48
+UINT32 = struct.Struct("<I")
+
 class TC66Monitor:
     def __init__(self, port='/dev/ttyACM0', baudrate=115200, timeout=5):
         self.port = port
@@ -16,6 +23,9 @@ class TC66Monitor:
             -122, -12, 2, 96, -127, 111, -102, 11,
             -89, -15, 6, 97, -102, -72, 114, -120
         ]
+        # ECB keeps no state between blocks, so one cipher, with its key
+        # schedule expanded once, decrypts every response
+        self._aes = AES.new(bytes(value & 255 for value in self.key), AES.MODE_ECB)
         
     def connect(self):
         """Connect to the TC66 device"""
@@ -26,6 +36,13 @@ class TC66Monitor:
                 timeout=self.timeout,
                 write_timeout=0
             )
+            try:
+                # Ask the driver to hand over bytes as they arrive instead of
+                # buffering them; only Linux supports this, and only some
+                # USB-serial drivers honour it
+                self.serial.set_low_latency_mode(True)
+            except (AttributeError, ValueError):
+                pass
             return True
         except Exception as e:
             print(f"Error connecting to {self.port}: {e}")
@@ -86,19 +103,19 @@ class TC66Monitor:
         
     def decode_response(self, data):
         """Decrypt and decode the response"""
-        # Convert key for AES decryption
-        key = bytes([value & 255 for value in self.key])
-            
         # Decrypt the data
         try:
-            aes = AES.new(key, AES.MODE_ECB)
-            decrypted = aes.decrypt(data)
+            decrypted = self._aes.decrypt(data)
         except Exception as e:
             print(f"Error decrypting data: {e}")
             return None
             
+        (voltage, current, power, _, _, resistance, accumulated_current,
+         accumulated_power, _, _, temperature_sign, temperature,
+         data_plus, data_minus) = MEASUREMENTS.unpack_from(decrypted, MEASUREMENTS_OFFSET)
+        
         # Determine temperature multiplier
-        if self.decode_integer(decrypted, 88) == 1:
+        if temperature_sign == 1:
             temperature_multiplier = -1
         else:
             temperature_multiplier = 1
@@ -106,24 +123,20 @@ class TC66Monitor:
         # Extract and return the values
         return {
             "timestamp": time.time(),
-            "voltage": self.decode_integer(decrypted, 48, 10000),
-            "current": self.decode_integer(decrypted, 52, 100000),
-            "power": self.decode_integer(decrypted, 56, 10000),
-            "resistance": self.decode_integer(decrypted, 68, 10),
-            "accumulated_current": self.decode_integer(decrypted, 72),
-            "accumulated_power": self.decode_integer(decrypted, 76),
-            "temperature": self.decode_integer(decrypted, 92) * temperature_multiplier,
-            "data_plus": self.decode_integer(decrypted, 96, 100),
-            "data_minus": self.decode_integer(decrypted, 100, 100),
+            "voltage": voltage / 10000,
+            "current": current / 100000,
+            "power": power / 10000,
+            "resistance": resistance / 10,
+            "accumulated_current": float(accumulated_current),
+            "accumulated_power": float(accumulated_power),
+            "temperature": float(temperature * temperature_multiplier),
+            "data_plus": data_plus / 100,
+            "data_minus": data_minus / 100,
         }
         
     def decode_integer(self, data, first_byte, divider=1):
         """Decode an integer from the decrypted data"""
-        temp4 = data[first_byte] & 255
-        temp3 = data[first_byte + 1] & 255
-        temp2 = data[first_byte + 2] & 255
-        temp1 = data[first_byte + 3] & 255
-        return ((((temp1 << 24) | (temp2 << 16)) | (temp3 << 8)) | temp4) / float(divider)
+        return UINT32.unpack_from(data, first_byte)[0] / float(divider)
         
     def format_data(self, data):
         """Format the data as a string"""
@@ -150,6 +163,9 @@ class TC66Monitor:
             if csv:
                 print("timestamp,voltage,current,power,resistance,temperature")
                 
+            # Sample on a fixed schedule, so the time spent reading and
+            # printing doesn't push later samples back
+            next_sample = time.monotonic()
             while True:
                 data = self.read_data()
                 if data:
@@ -160,7 +176,8 @@ class TC66Monitor:
                 else:
                     print("Failed to read data")
                     
-                time.sleep(interval)
+                next_sample += interval
+                time.sleep(max(0.0, next_sample - time.monotonic()))
                 
         except KeyboardInterrupt:
             print("\nMonitoring stopped")
@@ -5,9 +5,9 @@ This script tests the TC66 power monitor implementation.
 """
 
 import argparse
+import sys
 import time
 import logging
-from datetime import datetime
 from power_monitor import TC66PowerMonitor, MockPowerMonitor
 
 # Set up logging
@@ -17,6 +17,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# One sample row, formatted and written in a single call per tick
+ROW_FORMAT = "{:20} | {:12.3f} | {:12.3f} | {:12.3f} | {:15.1f} | {:12.1f}\n"
+
 def main():
     """Main function to test the TC66 power monitor."""
     parser = argparse.ArgumentParser(description='Test TC66 power monitor')
@@ -43,24 +46,37 @@ def main():
 
         # Run continuous monitoring loop
         logger.info(f"Starting monitoring loop (interval: {args.interval}s, duration: {args.duration}s)")
-        start_time = time.time()
+        start_time = time.monotonic()
+        samples = 0
+        # The HH:MM:SS part of the timestamp only changes once a second
+        last_second = -1
+        second_text = ""
         
         print(f"{'Time':20} | {'Voltage (V)':12} | {'Current (A)':12} | {'Power (W)':12} | {'Temperature (°C)':15} | {'Battery (%)':12}")
         print("-" * 90)
         
-        while time.time() - start_time < args.duration:
-            # Get power reading
-            reading = monitor.get_current_power_reading()
-            status = monitor.get_current_status()
+        while time.monotonic() - start_time < args.duration:
+            # Get power reading and status from a single reading
+            snapshot = monitor.get_full_snapshot()
             
-            # Current time
-            current_time = datetime.now().strftime("%H:%M:%S.%f")[:-3]
+            # Current time, to the millisecond
+            now = time.time()
+            second = int(now)
+            if second != last_second:
+                last_second = second
+                second_text = time.strftime("%H:%M:%S", time.localtime(second))
+            current_time = f"{second_text}.{int((now - second) * 1000):03d}"
             
             # Print formatted data
-            print(f"{current_time:20} | {reading['voltage']:12.3f} | {reading['current']:12.3f} | {reading['power']:12.3f} | {reading['temperature']:15.1f} | {status['battery_level']:12.1f}")
+            sys.stdout.write(ROW_FORMAT.format(
+                current_time, snapshot['voltage'], snapshot['current'],
+                snapshot['power'], snapshot['temperature'], snapshot['battery_level']
+            ))
             
-            # Sleep for interval
-            time.sleep(args.interval)
+            # Sleep until the next sample is due, so the time spent reading
+            # and printing doesn't push later samples back
+            samples += 1
+            time.sleep(max(0.0, start_time + samples * args.interval - time.monotonic()))
         
         # Test prediction
         logger.info("Testing power availability prediction...")
@@ -47,24 +47,26 @@ def main():
 
         # Run continuous monitoring loop
         logger.info(f"Starting monitoring loop (interval: {args.interval}s, duration: {args.duration}s)")
-        start_time = time.time()
+        start_time = time.monotonic()
+        samples = 0
         
         print(f"{'Time':20} | {'Voltage (V)':12} | {'Current (A)':12} | {'Power (W)':12} | {'Temperature (°C)':15} | {'Battery (%)':12}")
         print("-" * 90)
         
-        while time.time() - start_time < args.duration:
-            # Get power reading
-            reading = monitor.get_current_power_reading()
-            status = monitor.get_current_status()
+        while time.monotonic() - start_time < args.duration:
+            # Get power reading and status from a single reading
+            snapshot = monitor.get_full_snapshot()
             
             # Current time
             current_time = datetime.now().strftime("%H:%M:%S.%f")[:-3]
             
             # Print formatted data
-            print(f"{current_time:20} | {reading['voltage']:12.3f} | {reading['current']:12.3f} | {reading['power']:12.3f} | {reading['temperature']:15.1f} | {status['battery_level']:12.1f}")
+            print(f"{current_time:20} | {snapshot['voltage']:12.3f} | {snapshot['current']:12.3f} | {snapshot['power']:12.3f} | {snapshot['temperature']:15.1f} | {snapshot['battery_level']:12.1f}")
             
-            # Sleep for interval
-            time.sleep(args.interval)
+            # Sleep until the next sample is due, so the time spent reading
+            # and printing doesn't push later samples back
+            samples += 1
+            time.sleep(max(0.0, start_time + samples * args.interval - time.monotonic()))
         
         # Test prediction
         logger.info("Testing power availability prediction...")
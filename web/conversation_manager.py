@@ -1,8 +1,14 @@
 import os
-import uuid
+import tempfile
+import time
+import secrets
 from datetime import datetime
+from html import escape
 import json
 
+# Pages rendered within this many seconds of each other share a power reading
+POWER_STATUS_TTL = 1.0
+
 class ConversationManager:
     def __init__(self, static_pages_dir="static/conversations", request_queue=None, power_monitor=None):
         self.pages_dir = static_pages_dir
@@ -12,11 +18,14 @@ class ConversationManager:
         # Create directory if it doesn't exist
         os.makedirs(self.pages_dir, exist_ok=True)
         
+        # (monotonic time, status) of the last power status read
+        self._power_status_cache = (0.0, None)
+        
     def create_new_conversation(self, initial_prompt, estimated_time=None, request_id=None, conversation_id=None):
         """Create a new conversation with initial prompt"""
         # Generate unique conversation ID if not provided
         if not conversation_id:
-            conversation_id = str(uuid.uuid4())
+            conversation_id = secrets.token_hex(16)
         
         # Create directory for this conversation
         conversation_dir = f"{self.pages_dir}/{conversation_id}"
@@ -31,6 +40,18 @@ class ConversationManager:
         
         return conversation_id
     
+    def _get_power_status(self):
+        """Get the power status shown on pages, reusing a very recent reading"""
+        if not self.power_monitor:
+            return {'battery_level': 0, 'solar_output': 0}
+        
+        cached_at, status = self._power_status_cache
+        now = time.monotonic()
+        if status is None or now - cached_at >= POWER_STATUS_TTL:
+            status = self.power_monitor.get_current_status()
+            self._power_status_cache = (now, status)
+        return status
+        
     def generate_basic_page(self, conversation_id, prompt):
         """Generate a basic HTML page for a new conversation without power info"""
         html_content = f"""
@@ -54,7 +75,7 @@ class ConversationManager:
             
             <h2>Your prompt is in queue</h2>
             <div class="prompt">
-                <p><strong>You:</strong> {prompt}</p>
+                <p><strong>You:</strong> {escape(prompt)}</p>
             </div>
             
             <div class="status">
@@ -68,16 +89,12 @@ class ConversationManager:
         </html>
         """
         
-        # Write HTML to file
-        with open(f"{self.pages_dir}/{conversation_id}/index.html", 'w') as f:
-            f.write(html_content)
+        self._write_page(conversation_id, html_content)
     
     def generate_waiting_page(self, conversation_id, prompt, request_id, estimated_time):
         """Generate HTML page showing waiting status with power information"""
         # Get current power status
-        power_status = self.power_monitor.get_current_status() if self.power_monitor else {
-            'battery_level': 0, 'solar_output': 0
-        }
+        power_status = self._get_power_status()
         
         queue_position = self.request_queue.get_queue_position(request_id) if self.request_queue else None
         
@@ -111,7 +128,7 @@ class ConversationManager:
             
             <h2>Your prompt is in queue</h2>
             <div class="prompt">
-                <p><strong>You:</strong> {prompt}</p>
+                <p><strong>You:</strong> {escape(prompt)}</p>
             </div>
             
             <div class="status">
@@ -127,9 +144,7 @@ class ConversationManager:
         </html>
         """
         
-        # Write HTML to file
-        with open(f"{self.pages_dir}/{conversation_id}/index.html", 'w') as f:
-            f.write(html_content)
+        self._write_page(conversation_id, html_content)
     
     def update_conversation_page(self, conversation_id):
         """Update conversation page with completed responses"""
@@ -146,12 +161,10 @@ class ConversationManager:
         requests = self.request_queue.get_conversation_requests(conversation_id) if self.request_queue else []
         
         # Get current power status
-        power_status = self.power_monitor.get_current_status() if self.power_monitor else {
-            'battery_level': 0, 'solar_output': 0
-        }
+        power_status = self._get_power_status()
         
-        # Build conversation HTML
-        html_content = f"""
+        # Build conversation HTML from parts, joined once at the end
+        parts = [f"""
         <!DOCTYPE html>
         <html>
         <head>
@@ -185,30 +198,30 @@ class ConversationManager:
                 <p>Current solar output: {power_status.get('solar_output', 0):.2f}W</p>
                 <p>Battery level: {power_status.get('battery_level', 0):.1f}%</p>
             </div>
-        """
+        """]
         
         # Add conversation exchanges
         for request in requests:
-            html_content += f"""
+            parts.append(f"""
             <div class="prompt">
-                <p><strong>You:</strong> {request['prompt']}</p>
+                <p><strong>You:</strong> {escape(request['prompt'])}</p>
             </div>
-            """
+            """)
             
             if request['status'] == 'completed' and request['response']:
-                html_content += f"""
+                parts.append(f"""
                 <div class="response">
-                    <p><strong>AI:</strong> {request['response']}</p>
+                    <p><strong>AI:</strong> {escape(request['response'])}</p>
                 </div>
-                """
+                """)
             elif request['status'] == 'processing':
-                html_content += f"""
+                parts.append(f"""
                 <div class="status">
                     <p>Processing your request...</p>
                     <p>This page will automatically refresh when the response is ready.</p>
                 </div>
                 <meta http-equiv="refresh" content="30">
-                """
+                """)
             elif request['status'] == 'queued':
                 # Try to parse estimated completion time
                 try:
@@ -220,35 +233,51 @@ class ConversationManager:
                 except (ValueError, AttributeError):
                     time_str = "Unknown"
                 
-                html_content += f"""
+                parts.append(f"""
                 <div class="status">
                     <p>Your request is queued.</p>
                     <p>Estimated response time: {time_str}</p>
                     <p>This page will automatically refresh when the response is ready.</p>
                 </div>
                 <meta http-equiv="refresh" content="60">
-                """
+                """)
         
         # Add form for new prompt if most recent request is completed or if there are no requests
         if not requests or requests[-1]['status'] == 'completed':
-            html_content += f"""
+            parts.append(f"""
             <form action="/submit" method="post">
-                <input type="hidden" name="conversation_id" value="{conversation_id}">
+                <input type="hidden" name="conversation_id" value="{escape(conversation_id)}">
                 <textarea name="prompt" placeholder="Enter your next prompt..."></textarea>
                 <button type="submit">Submit</button>
             </form>
-            """
+            """)
         
-        html_content += """
+        parts.append(f"""
             <p><a href="/">Return to home page</a></p>
-            <p><a href="/download/{conversation_id}">Download conversation</a></p>
+            <p><a href="/download/{escape(conversation_id)}">Download conversation</a></p>
         </body>
         </html>
-        """
+        """)
         
-        # Write HTML to file
-        with open(f"{self.pages_dir}/{conversation_id}/index.html", 'w') as f:
-            f.write(html_content)
+        self._write_page(conversation_id, "".join(parts))
+            
+    def _write_page(self, conversation_id, html_content):
+        """Replace a conversation's page in one step
+        
+        The page is written to a temporary file next to it and renamed over
+        it, so a page being served while it is regenerated is never partial.
+        """
+        path = self.get_conversation_path(conversation_id)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            # mkstemp creates the file private to the owner
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, 'w') as f:
+                f.write(html_content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
             
     def get_conversation_path(self, conversation_id):
         """Get the path to a conversation's HTML file"""